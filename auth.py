@@ -1,15 +1,23 @@
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
+from typing import Optional
+import uuid
 from jose import JWTError, jwt, ExpiredSignatureError
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-import crud
+from sqlalchemy.ext.asyncio import AsyncSession
+import crud_async
 import config
 import log
-from database import get_db
+import models
+from auth_cache import auth_cache
+from token_cache import verified_tokens
+from database import get_async_db
+from presence import presence
 import bcrypt
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
+REFRESH_TOKEN_TYPE = "refresh"
 settings = config.settings
 
 
@@ -18,7 +26,7 @@ def verify_password(plain_password, hashed_password):
 
 
 def get_password_hash(password):
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(settings.BCRYPT_ROUNDS)).decode("utf-8")
 
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -27,33 +35,37 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
         expire = datetime.now(timezone.utc) + expires_delta
     else:
         expire = datetime.now(timezone.utc) + timedelta(days=7)
-    to_encode.update({"exp": expire})
+    # jti 用于吊销单个令牌
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
 
 def create_refresh_token(data: dict):
     expire = datetime.now(timezone.utc) + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
-    data.update({"exp": expire})
+    data.setdefault("jti", uuid.uuid4().hex)
+    # 刷新令牌只能用于 /auth/refresh，不能作为访问令牌
+    data.update({"exp": expire, "type": REFRESH_TOKEN_TYPE})
     encoded_jwt = jwt.encode(data, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
 
-def decode_token(token):
+def decode_claims(token) -> dict:
+    """校验令牌并返回其内容，已验证过的令牌直接从缓存读取"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        payload = verified_tokens.decode(token)
         user_id: str = payload.get("sub")
         device_id: str = payload.get("device_id")
 
-        if user_id is None or device_id is None:
+        if user_id is None or device_id is None or payload.get("type") == REFRESH_TOKEN_TYPE:
             raise credentials_exception
 
-        return user_id, device_id
+        return payload
     except ExpiredSignatureError as e:
         # exp 字段过期
         log.error(f"jwt decode exception: {e}", logger_name=__name__)
@@ -67,32 +79,84 @@ def decode_token(token):
         raise credentials_exception
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    user_id, _ = decode_token(token)
-    user = crud.get_user(db, user_id=user_id)
-    if user is None:
+def decode_token(token):
+    payload = decode_claims(token)
+    return payload["sub"], payload["device_id"]
+
+
+@dataclass
+class AuthContext:
+    """当前请求令牌对应的用户和设备"""
+    user_id: str
+    device_id: str
+    user: Optional[models.User]
+    device: Optional[models.Device]
+    claims: dict
+
+
+async def get_auth_context(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    """
+    解码令牌并查询用户和设备，优先使用认证缓存
+
+    同一请求内 FastAPI 只调用一次该依赖，get_current_user 和 get_current_active_device 共享结果，
+    令牌只解码一次
+    """
+    claims = decode_claims(token)
+    user_id, device_id = claims["sub"], claims["device_id"]
+    cached = auth_cache.get(user_id, device_id)
+    if cached:
+        return AuthContext(user_id, device_id, *cached, claims)
+
+    user = await crud_async.get_user(db, user_id=user_id)
+    device = await crud_async.get_user_device(db, user_id, device_id) if user else None
+    if user and device:
+        auth_cache.put(user, device)
+    return AuthContext(user_id, device_id, user, device, claims)
+
+
+async def get_current_user(context: AuthContext = Depends(get_auth_context)):
+    """
+    令牌对应的用户，令牌的设备也必须存在
+
+    升级前签发的令牌没有 family 和 jti，删除设备时无法吊销，只能按设备是否存在拒绝
+    """
+    if context.user is None or context.device is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not find user",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    return user
+    return context.user
+
+
+async def get_current_device(context: AuthContext = Depends(get_auth_context)):
+    """令牌对应的设备，不要求设备在线（如离线设备补齐同步）"""
+    if context.device is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not find device",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return context.device
 
 
 async def get_current_active_device(
-        token: str = Depends(oauth2_scheme),
-        db: Session = Depends(get_db)
+        context: AuthContext = Depends(get_auth_context),
+        db: AsyncSession = Depends(get_async_db)
 ):
-    _, device_id = decode_token(token)
-    device = crud.get_device(db, device_id=device_id)
-    if device is None or not device.is_active:
+    device = context.device
+    if device is not None and not presence.is_active(device):
+        # 缓存的设备可能是在其他 worker 上线之前查询的，拒绝前重新查询数据库
+        device = await crud_async.get_user_device(db, context.user_id, context.device_id)
+        if device is not None and device.is_active and context.user is not None:
+            auth_cache.put(context.user, device)
+    if device is None or not presence.is_active(device):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not find device",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    # 更新设备最后活动时间
-    device.last_active = datetime.now(timezone.utc)
-    db.flush()
+    # 更新设备最后活动时间，由 presence 合并后定期批量写入
+    presence.touch(device.id)
     return device
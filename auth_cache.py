@@ -0,0 +1,73 @@
+"""
+认证用户和设备的内存缓存
+每个需要认证的请求都要按令牌查询用户和设备，缓存 AUTH_CACHE_TTL_SECONDS 秒内的查询结果。
+缓存的是与数据库会话无关的副本，只能读取；设备改名、删除和退出登录时清除，
+其他 worker 的缓存通过消息总线清除。设备在线状态写回数据库后，本 worker 清除对应设备的缓存
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy import inspect
+
+import models
+from config import settings
+
+
+def _detached_copy(obj):
+    """复制 ORM 对象的列属性，副本不属于任何会话，会话提交或关闭后仍可读取"""
+    mapper = inspect(obj).mapper
+    return mapper.class_(**{attr.key: getattr(obj, attr.key) for attr in mapper.column_attrs})
+
+
+class AuthCache:
+    """按 (user_id, device_id) 缓存，超过容量时淘汰最久未使用的条目"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        # (user_id, device_id) -> (过期时间, 用户, 设备)
+        self._entries: OrderedDict[tuple[str, str], tuple[float, models.User, models.Device]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, user_id: str, device_id: str) -> Optional[tuple[models.User, models.Device]]:
+        key = (user_id, device_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1], entry[2]
+            if entry:
+                del self._entries[key]
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, user: models.User, device: models.Device):
+        if self._ttl <= 0:
+            return
+        key = (user.id, device.id)
+        entry = (time.monotonic() + self._ttl, _detached_copy(user), _detached_copy(device))
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_device(self, user_id: str, device_id: str):
+        with self._lock:
+            if self._entries.pop((user_id, device_id), None):
+                self.stats["invalidations"] += 1
+
+    def invalidate_devices(self, device_ids: set[str]):
+        """在线状态写回数据库后清除这些设备的缓存，缓存中的 is_active 不再有效"""
+        with self._lock:
+            for key in [key for key in self._entries if key[1] in device_ids]:
+                del self._entries[key]
+                self.stats["invalidations"] += 1
+
+
+# 全局认证缓存实例
+auth_cache = AuthCache(settings.AUTH_CACHE_TTL_SECONDS, settings.AUTH_CACHE_MAX_ENTRIES)
@@ -0,0 +1,78 @@
+"""
+一次性回填：按新的压缩规则重写已有的文本剪贴板条目
+
+旧版本对所有文本都设置了 is_compressed=True，但内容实际原样存储。
+按 id 分批处理，每批单独提交，可以在服务运行时执行：
+
+    python backfill_compression.py --batch-size 500
+"""
+import argparse
+import time
+
+from sqlalchemy import func
+
+import compression
+import log
+import models
+from database import get_db_context
+
+
+def backfill(batch_size: int, pause: float) -> tuple[int, int, int]:
+    """
+    Returns:
+        (处理的条目数, 压缩前字节数, 压缩后字节数)
+    """
+    last_id = 0
+    processed = bytes_before = bytes_after = 0
+    while True:
+        with get_db_context() as db:
+            items = db.query(models.ClipboardItem).filter(
+                models.ClipboardItem.id > last_id,
+                models.ClipboardItem.item_type == 'text',
+                models.ClipboardItem.content_compressed.is_(None)
+            ).order_by(models.ClipboardItem.id.asc()).limit(batch_size).all()
+            if not items:
+                break
+
+            for item in items:
+                compressed = compression.compress_text(item.content)
+                size = len(item.content.encode('utf-8')) if item.content else 0
+                bytes_before += size
+                if compressed is None:
+                    item.is_compressed = False
+                    bytes_after += size
+                else:
+                    item.content_compressed = compressed
+                    item.content = None
+                    item.is_compressed = True
+                    bytes_after += len(compressed)
+            db.commit()
+
+            last_id = items[-1].id
+            processed += len(items)
+        log.info(f'Backfilled {processed} text items, last id: {last_id}')
+        if pause:
+            time.sleep(pause)
+    return processed, bytes_before, bytes_after
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compress existing text clipboard items")
+    parser.add_argument("--batch-size", type=int, default=500, help="rows per transaction")
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    args = parser.parse_args()
+
+    log.setup_logging()
+    with get_db_context() as db:
+        total = db.query(func.count(models.ClipboardItem.id)).filter(
+            models.ClipboardItem.item_type == 'text',
+            models.ClipboardItem.content_compressed.is_(None)
+        ).scalar()
+    log.info(f'Backfill compression start. candidate items: {total}')
+
+    processed, bytes_before, bytes_after = backfill(args.batch_size, args.pause)
+    log.info(f'Backfill compression done. items: {processed} bytes: {bytes_before} -> {bytes_after}')
+
+
+if __name__ == "__main__":
+    main()
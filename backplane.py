@@ -0,0 +1,266 @@
+"""
+跨 worker 的消息总线
+ConnectionManager 只保存本进程的 WebSocket 连接。多个 uvicorn worker 或多个节点部署时，
+需要通知的事件通过总线发布给所有 worker，每个 worker 只投递给自己持有的连接
+
+BACKPLANE_URL:
+    为空          只在本进程内分发（单 worker）
+    tcp://host:port  连接本模块自带的 broker，用于本地和测试：python backplane.py --port 7000
+    redis://...   使用 Redis pub/sub，需要安装 redis
+"""
+import argparse
+import asyncio
+import json
+import struct
+import uuid
+from typing import Callable, Optional
+from urllib.parse import urlparse
+
+import log
+from config import settings
+
+# tcp broker 帧格式：4字节大端长度 + JSON
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+RECONNECT_MAX_DELAY_SECONDS = 10
+CONNECT_TIMEOUT_SECONDS = 5
+
+
+class Backplane:
+    """
+    进程内总线，也是其他实现的基类
+
+    publish 总是先投递给本进程，再交给 _send 发给其他 worker；
+    其他 worker 发布的事件由子类收到后调用 _dispatch
+    """
+
+    def __init__(self):
+        # 区分事件来源，忽略自己发布后被转发回来的事件
+        self.instance_id = uuid.uuid4().hex
+        self._handler: Optional[Callable[[dict], None]] = None
+        self.stats = {
+            "published": 0,
+            "received": 0,
+            "publish_failures": 0,
+        }
+
+    def set_handler(self, handler: Callable[[dict], None]):
+        """设置事件处理函数，每个 worker 在其中投递给本地连接"""
+        self._handler = handler
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, event: dict):
+        self.stats["published"] += 1
+        self._handle(event)
+        try:
+            await self._send({"origin": self.instance_id, "event": event})
+        except Exception as e:
+            self.stats["publish_failures"] += 1
+            log.warning(f'Backplane publish failed: {e}')
+
+    async def _send(self, envelope: dict):
+        pass
+
+    def _dispatch(self, envelope: dict):
+        """处理从其他 worker 收到的事件"""
+        if envelope.get("origin") == self.instance_id:
+            return
+        self.stats["received"] += 1
+        self._handle(envelope["event"])
+
+    def _handle(self, event: dict):
+        if not self._handler:
+            return
+        try:
+            self._handler(event)
+        except Exception as e:
+            log.error(f'Handle backplane event failed: {e}', exc_info=True)
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    size, = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f"frame too large: {size}")
+    return await reader.readexactly(size)
+
+
+def encode_frame(envelope: dict) -> bytes:
+    payload = json.dumps(envelope, separators=(",", ":")).encode()
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class TcpBackplane(Backplane):
+    """连接自带 broker 的总线，断线后自动重连，断线期间只投递给本进程"""
+
+    def __init__(self, host: str, port: int):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connected = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+        try:
+            # 等待首次连接，确保启动完成后就能收到其他 worker 的事件
+            await asyncio.wait_for(self._connected.wait(), CONNECT_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            log.warning(f'Backplane broker {self.host}:{self.port} not reachable, retrying in background')
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    async def _run(self):
+        delay = 0.5
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as e:
+                log.debug(f'Connect backplane broker failed: {e}')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY_SECONDS)
+                continue
+
+            log.info(f'Backplane connected to {self.host}:{self.port}')
+            self._writer = writer
+            self._connected.set()
+            delay = 0.5
+            try:
+                while True:
+                    self._dispatch(json.loads(await read_frame(reader)))
+            except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+                log.warning(f'Backplane connection lost: {e}')
+            finally:
+                self._writer = None
+                self._connected.clear()
+                writer.close()
+
+    async def _send(self, envelope: dict):
+        writer = self._writer
+        if writer is None:
+            raise ConnectionError("broker not connected")
+        writer.write(encode_frame(envelope))
+        await asyncio.wait_for(writer.drain(), settings.WS_SEND_TIMEOUT_SECONDS)
+
+
+class RedisBackplane(Backplane):
+    """基于 Redis pub/sub 的总线"""
+
+    def __init__(self, url: str, channel: str):
+        super().__init__()
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("BACKPLANE_URL uses redis but the redis package is not installed")
+        self.channel = channel
+        self._client = redis.from_url(url)
+        self._task: Optional[asyncio.Task] = None
+        self._subscribed = asyncio.Event()
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self._subscribed.wait(), CONNECT_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            log.warning('Backplane redis not reachable, retrying in background')
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self._client.aclose()
+
+    async def _run(self):
+        delay = 0.5
+        while True:
+            pubsub = self._client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                self._subscribed.set()
+                delay = 0.5
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self._dispatch(json.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(f'Backplane redis subscription lost: {e}')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY_SECONDS)
+            finally:
+                self._subscribed.clear()
+                await pubsub.aclose()
+
+    async def _send(self, envelope: dict):
+        await self._client.publish(self.channel, json.dumps(envelope, separators=(",", ":")))
+
+
+def create_backplane(url: str) -> Backplane:
+    if not url:
+        return Backplane()
+    parsed = urlparse(url)
+    if parsed.scheme == "tcp":
+        return TcpBackplane(parsed.hostname or "127.0.0.1", parsed.port or 7000)
+    if parsed.scheme in ("redis", "rediss", "unix"):
+        return RedisBackplane(url, settings.BACKPLANE_CHANNEL)
+    raise ValueError(f"Unsupported BACKPLANE_URL: {url}")
+
+
+async def run_broker(host: str, port: int):
+    """最简单的转发 broker：把每个客户端发来的帧转发给其他所有客户端"""
+    clients: set[asyncio.StreamWriter] = set()
+
+    async def forward(writer: asyncio.StreamWriter, frame: bytes):
+        try:
+            writer.write(frame)
+            await asyncio.wait_for(writer.drain(), settings.WS_SEND_TIMEOUT_SECONDS)
+        except Exception:
+            clients.discard(writer)
+            writer.close()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        clients.add(writer)
+        log.info(f'Broker client connected: {writer.get_extra_info("peername")}')
+        try:
+            while True:
+                payload = await read_frame(reader)
+                frame = FRAME_HEADER.pack(len(payload)) + payload
+                await asyncio.gather(*(forward(client, frame) for client in list(clients) if client is not writer))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            clients.discard(writer)
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    log.info(f'Backplane broker listening on {host}:{port}')
+    async with server:
+        await server.serve_forever()
+
+
+# 全局消息总线实例
+backplane = create_backplane(settings.BACKPLANE_URL)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the tcp backplane broker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7000)
+    args = parser.parse_args()
+
+    log.setup_logging()
+    try:
+        asyncio.run(run_broker(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
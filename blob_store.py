@@ -0,0 +1,138 @@
+"""
+内容寻址的文件存储
+图片/文件按内容的 sha256 存放在 uploads/blobs/<前2位>/<3-4位>/<hash>，
+相同内容只保存一份，由 blobs 表记录被 ClipboardItem 引用的次数
+
+新内容与删除无引用文件可能并发：blob 文件存在、但引用还没提交时，它可能正被当作无引用文件删除。
+因此上传内容（仍然打开的上传文件或续传的临时文件）保留到引用提交后，由 finish_store 确认 blob 仍然存在，
+期间被删除时用上传内容恢复；remove_blob_files 先把文件改名，再确认没有被重新引用才真正删除
+"""
+import os
+import shutil
+import threading
+import uuid
+from typing import Optional
+
+from fastapi import UploadFile
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+import log
+import models
+from file_storage import UPLOAD_DIR, SavedFile, copy_stream, hash_stream, max_upload_size
+
+BLOB_DIR = os.path.join(UPLOAD_DIR, "blobs")
+
+
+def blob_path(content_hash: str) -> str:
+    """按哈希前缀分两级目录，避免单个目录下文件过多"""
+    return os.path.join(BLOB_DIR, content_hash[:2], content_hash[2:4], content_hash)
+
+
+def parse_blob_path(relative_path: str) -> Optional[str]:
+    """从 uploads 下的相对路径 blobs/aa/bb/<hash> 中解析出哈希，不是 blob 路径时返回 None"""
+    parts = relative_path.split("/")
+    if len(parts) != 4 or parts[0] != "blobs":
+        return None
+    content_hash = parts[3]
+    if len(content_hash) != 64 or parts[1] != content_hash[:2] or parts[2] != content_hash[2:4]:
+        return None
+    if any(c not in "0123456789abcdef" for c in content_hash):
+        return None
+    return content_hash
+
+
+def _place(staging_path: str, path: str):
+    """把续传的临时文件放到 blob 路径，临时文件本身保留（硬链接，不支持时复制）"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        os.link(staging_path, path)
+    except FileExistsError:
+        pass
+    except OSError:
+        tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+        shutil.copyfile(staging_path, tmp_path)
+        os.replace(tmp_path, path)
+
+
+def stage(staging_path: str, size: int, content_hash: str) -> SavedFile:
+    """续传完成：内容还不存在时放入 blob 路径，临时文件保留到 finish_store"""
+    path = blob_path(content_hash)
+    if not os.path.exists(path):
+        _place(staging_path, path)
+    return SavedFile(path=path, size=size, content_hash=content_hash, staging_path=staging_path)
+
+
+def _store(src, max_size: int, cancelled: threading.Event) -> SavedFile:
+    size, content_hash = hash_stream(src, max_size, cancelled)
+    path = blob_path(content_hash)
+    if not os.path.exists(path):
+        # 新内容才写入磁盘，重复内容只读取一次计算哈希
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        src.seek(0)
+        copy_stream(src, path, size, cancelled)
+    return SavedFile(path=path, size=size, content_hash=content_hash, source=src)
+
+
+async def save_upload_file(file: UploadFile) -> SavedFile:
+    """
+    把上传文件存入内容寻址存储
+
+    Raises:
+        UploadTooLargeError: 内容超过上限，不会留下任何文件
+    """
+    cancelled = threading.Event()
+    try:
+        return await run_in_threadpool(_store, file.file, max_upload_size(), cancelled)
+    except BaseException:
+        cancelled.set()
+        log.warning(f'Upload of {file.filename} failed, partial file removed')
+        raise
+
+
+def _finish(saved_file: SavedFile):
+    if not os.path.exists(saved_file.path):
+        # 引用提交前 blob 被当作无引用文件删除了
+        os.makedirs(os.path.dirname(saved_file.path), exist_ok=True)
+        if saved_file.staging_path:
+            os.replace(saved_file.staging_path, saved_file.path)
+        elif saved_file.source:
+            saved_file.source.seek(0)
+            copy_stream(saved_file.source, saved_file.path, saved_file.size, threading.Event())
+        log.warning(f'Blob {saved_file.content_hash} was removed before its reference was committed, restored')
+    if saved_file.staging_path:
+        try:
+            os.remove(saved_file.staging_path)
+        except FileNotFoundError:
+            pass
+
+
+async def finish_store(saved_file: SavedFile):
+    """
+    引用 blob 的条目提交后（或放弃创建条目时）调用
+
+    确认 blob 文件仍然存在（不存在时用上传内容恢复），然后删除续传的临时文件
+    """
+    await run_in_threadpool(_finish, saved_file)
+
+
+def remove_blob_files(db: Session, content_hashes: list[str]):
+    """
+    删除已经没有引用的 blob 文件
+
+    先改名再确认 blobs 表中没有该哈希：改名前提交的引用在这里会看到，文件改回原名；
+    之后提交的引用由 finish_store 发现文件不存在并恢复
+    """
+    for content_hash in content_hashes:
+        path = blob_path(content_hash)
+        removing_path = f"{path}.{uuid.uuid4().hex}.removing"
+        try:
+            os.replace(path, removing_path)
+        except FileNotFoundError:
+            continue
+        if db.query(models.Blob.hash).filter(models.Blob.hash == content_hash).first() is not None:
+            os.replace(removing_path, path)
+            log.debug(f'Blob {content_hash} referenced again, kept')
+            continue
+        os.remove(removing_path)
+        log.debug(f'Removed unreferenced blob {content_hash}')
@@ -0,0 +1,31 @@
+"""
+文本内容压缩
+超过 TEXT_COMPRESS_MIN_BYTES 的文本用 zlib 压缩后存入二进制列，较小的文本原样存储
+"""
+import zlib
+
+from config import settings
+
+
+def compress_text(text: str | None) -> bytes | None:
+    """
+    压缩文本
+
+    Returns:
+        压缩后的字节；文本低于阈值或压缩后没有变小时返回 None，表示应原样存储
+    """
+    if text is None:
+        return None
+    raw = text.encode("utf-8")
+    if len(raw) < settings.TEXT_COMPRESS_MIN_BYTES:
+        return None
+    compressed = zlib.compress(raw, settings.TEXT_COMPRESS_LEVEL)
+    if len(compressed) >= len(raw):
+        return None
+    return compressed
+
+
+def decompress_text(data: bytes | None) -> str | None:
+    if data is None:
+        return None
+    return zlib.decompress(data).decode("utf-8")
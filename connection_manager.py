@@ -1,27 +1,249 @@
+import asyncio
+from typing import Optional, Union
+
 from fastapi import WebSocket
+from starlette.websockets import WebSocketState
+
+import log
+import ws_codec
+from config import settings
+from ws_codec import EncodedMessage
+
+# 队列中的消息：JSON 文本（单个连接的消息）或共享编码结果的广播消息
+Message = Union[str, EncodedMessage]
+
+# 1013 Try Again Later：客户端重连后通过同步接口补齐遗漏的内容
+WS_CLOSE_SLOW_CONSUMER = 1013
+
+
+class Connection:
+    """
+    单个 WebSocket 连接
+
+    每个连接有独立的有界发送队列和写协程，慢连接只会阻塞自己的队列。
+    队列写满或单次发送超时的连接会被断开
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: str, device_id: str, manager: "ConnectionManager",
+                 fmt: str = ws_codec.FORMAT_JSON):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.device_id = device_id
+        # 通过子协议协商的消息编码
+        self.format = fmt
+        self.queue: asyncio.Queue[Message] = asyncio.Queue(maxsize=settings.WS_SEND_QUEUE_SIZE)
+        self.closed = False
+        # 心跳：最后一次收到客户端消息的时间（事件循环时钟），由 heartbeat 模块维护
+        self.last_seen = asyncio.get_running_loop().time()
+        self.pinged_at = 0.0
+        self.heartbeat_interval = float(settings.WS_HEARTBEAT_INTERVAL_SECONDS)
+        self.heartbeat_generation = 0
+        # 补发离线期间条目时暂存的实时消息 (条目id, 消息)，补发结束后去重发送
+        self.replaying = False
+        self._replay_buffer: list[tuple[int, Message]] = []
+        # 补发开始前已实时发送的条目id，补发时跳过；补发开始后不再记录
+        self._live_ids: Optional[set[int]] = set()
+        # 补发已覆盖到的条目id，补发结束后迟到的实时消息（通知在提交后才发出）不超过该id时丢弃
+        self._replayed_through = 0
+        self._manager = manager
+        self._writer_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def touch(self):
+        """收到客户端消息，连接仍然存活"""
+        self.last_seen = asyncio.get_running_loop().time()
+
+    def enqueue(self, message: Message, item_id: Optional[int] = None) -> bool:
+        """
+        放入发送队列，不等待发送完成；队列已满时断开该连接并返回 False
+
+        Args:
+            item_id: 消息对应的剪贴板条目，补发期间据此去重
+        """
+        if self.closed:
+            return False
+        if item_id is not None:
+            if item_id <= self._replayed_through:
+                return True
+            if self.replaying:
+                if len(self._replay_buffer) >= settings.WS_SEND_QUEUE_SIZE:
+                    return self._drop_slow_consumer("replay buffer full")
+                self._replay_buffer.append((item_id, message))
+                return True
+            if self._live_ids is not None:
+                self._live_ids.add(item_id)
+                if len(self._live_ids) > settings.WS_SEND_QUEUE_SIZE:
+                    # 客户端迟迟没有请求补发，不再记录
+                    self._live_ids = None
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            return self._drop_slow_consumer("send queue full")
+
+    def _drop_slow_consumer(self, reason: str) -> bool:
+        self._manager.stats["slow_consumers_dropped"] += 1
+        log.warning(f'Drop slow consumer user:{self.user_id} device:{self.device_id} reason: {reason}')
+        self.close_soon(WS_CLOSE_SLOW_CONSUMER, reason)
+        return False
+
+    def begin_replay(self) -> set[int]:
+        """
+        进入补发模式，之后的实时消息先暂存
+
+        Returns:
+            已经实时发送过、补发时应跳过的条目id
+        """
+        self.replaying = True
+        return self._live_ids or set()
+
+    async def send_replay(self, message: Message) -> bool:
+        """发送补发消息，队列满时等待而不是断开，超时视为慢连接"""
+        if self.closed:
+            return False
+        try:
+            await asyncio.wait_for(self.queue.put(message), settings.WS_SEND_TIMEOUT_SECONDS)
+            return True
+        except asyncio.TimeoutError:
+            self._manager.stats["send_timeouts"] += 1
+            return self._drop_slow_consumer("replay send timeout")
+
+    def end_replay(self, replayed_through: int):
+        """
+        退出补发模式，发送暂存的实时消息
+
+        Args:
+            replayed_through: 补发已覆盖到的最大条目id，暂存的和之后到达的该id及以前的实时消息都不再发送
+        """
+        buffered, self._replay_buffer = self._replay_buffer, []
+        self.replaying = False
+        self._live_ids = None
+        self._replayed_through = max(self._replayed_through, replayed_through)
+        for item_id, message in buffered:
+            self.enqueue(message, item_id)
+
+    async def _writer(self):
+        while True:
+            message = await self.queue.get()
+            try:
+                if isinstance(message, str):
+                    message = EncodedMessage(json_text=message)
+                # 广播消息每种编码只编码一次，由所有连接共享
+                data = message.encode(self.format)
+                send = self.websocket.send_text(data) if isinstance(data, str) else self.websocket.send_bytes(data)
+                await asyncio.wait_for(send, settings.WS_SEND_TIMEOUT_SECONDS)
+                self._manager.stats["messages_sent"] += 1
+            except asyncio.TimeoutError:
+                self._manager.stats["send_timeouts"] += 1
+                log.warning(f'Send timeout, drop slow consumer user:{self.user_id} device:{self.device_id}')
+                await self.close(WS_CLOSE_SLOW_CONSUMER, "send timeout")
+                return
+            except Exception as e:
+                log.warning(f'Send failed user:{self.user_id} device:{self.device_id} reason: {e}')
+                await self.close()
+                return
+
+    def close_soon(self, code: int = 1000, reason: str = ""):
+        """立即停止接收消息，在后台关闭连接"""
+        if self.closed:
+            return
+        self._mark_closed()
+        asyncio.get_running_loop().create_task(self._shutdown(code, reason))
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        if self.closed:
+            return
+        self._mark_closed()
+        await self._shutdown(code, reason)
+
+    def _mark_closed(self):
+        self.closed = True
+        # 立即从管理器移除，不再接收新消息
+        self._manager.remove(self)
+
+    async def _shutdown(self, code: int, reason: str):
+        if self._writer_task and self._writer_task is not asyncio.current_task():
+            self._writer_task.cancel()
+        if (self.websocket.application_state == WebSocketState.CONNECTED
+                and self.websocket.client_state == WebSocketState.CONNECTED):
+            try:
+                await asyncio.wait_for(self.websocket.close(code=code, reason=reason),
+                                       settings.WS_SEND_TIMEOUT_SECONDS)
+            except Exception as e:
+                log.debug(f'Close websocket failed: {e}')
 
 
 class ConnectionManager:
     def __init__(self):
-        # 存储WebSocket连接
-        self.active_connections: dict[str, WebSocket] = {}
-
-    async def connect(self, websocket: WebSocket, user_id: str, device_id: str):
-        await websocket.accept()
-        key = f"{user_id}_{device_id}"
-        self.active_connections[key] = websocket
-
-    def disconnect(self, user_id: str, device_id: str):
-        key = f"{user_id}_{device_id}"
-        if key in self.active_connections:
-            del self.active_connections[key]
-
-    async def send_personal_message(self, message: str, user_id: str, device_id: str):
-        key = f"{user_id}_{device_id}"
-        if key in self.active_connections:
-            await self.active_connections[key].send_text(message)
-
-    async def broadcast(self, message: str, user_id: str, exclude_device: str = None):
-        for key, connection in self.active_connections.items():
-            if key.startswith(f"{user_id}_") and (exclude_device is None or not key.endswith(exclude_device)):
-                await connection.send_text(message)
+        # 按 用户 -> 设备 两级索引存储WebSocket连接
+        self.active_connections: dict[str, dict[str, Connection]] = {}
+        self.connection_count = 0
+        self.stats = {
+            "messages_sent": 0,
+            "send_timeouts": 0,
+            "slow_consumers_dropped": 0,
+        }
+
+    async def connect(self, websocket: WebSocket, user_id: str, device_id: str) -> Connection:
+        fmt, subprotocol = ws_codec.negotiate(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=subprotocol)
+        devices = self.active_connections.setdefault(user_id, {})
+        previous = devices.get(device_id)
+        connection = Connection(websocket, user_id, device_id, self, fmt)
+        devices[device_id] = connection
+        if previous is None:
+            self.connection_count += 1
+        connection.start()
+        if previous:
+            # 同一设备重复连接，关闭旧连接
+            await previous.close(reason="replaced by new connection")
+        return connection
+
+    def remove(self, connection: Connection):
+        devices = self.active_connections.get(connection.user_id)
+        if not devices or devices.get(connection.device_id) is not connection:
+            return
+        del devices[connection.device_id]
+        self.connection_count -= 1
+        if not devices:
+            del self.active_connections[connection.user_id]
+
+    def get_connection(self, user_id: str, device_id: str) -> Optional[Connection]:
+        return self.active_connections.get(user_id, {}).get(device_id)
+
+    def is_connected(self, user_id: str, device_id: str) -> bool:
+        return self.get_connection(user_id, device_id) is not None
+
+    def get_online_devices(self, user_id: str) -> list[str]:
+        """用户当前在线的设备"""
+        return list(self.active_connections.get(user_id, {}))
+
+    def get_stats(self) -> dict:
+        return {
+            "connections": self.connection_count,
+            "users": len(self.active_connections),
+            **self.stats,
+        }
+
+    async def disconnect(self, connection: Connection):
+        await connection.close()
+
+    def send_personal_message(self, message: Message, user_id: str, device_id: str, item_id: int = None) -> bool:
+        connection = self.get_connection(user_id, device_id)
+        if connection:
+            return connection.enqueue(message, item_id)
+        return False
+
+    def broadcast(self, message: Message, user_id: str, exclude_device: str = None, item_id: int = None) -> int:
+        """发送给用户的所有在线设备（可排除来源设备），返回放入发送队列的连接数"""
+        sent = 0
+        for device_id, connection in list(self.active_connections.get(user_id, {}).items()):
+            if device_id != exclude_device and connection.enqueue(message, item_id):
+                sent += 1
+        return sent
+
+
+# 全局WebSocket连接管理器实例
+manager = ConnectionManager()
@@ -1,9 +1,13 @@
+from sqlalchemy import update, delete
 from sqlalchemy.orm import Session
 import models
 import schemas
+import search_index
 from auth import get_password_hash
 import uuid
 import hashlib
+from datetime import datetime, timedelta, timezone
+from config import settings
 
 
 def get_user(db: Session, user_id: str) -> type[models.User] | None:
@@ -61,25 +65,51 @@ def get_device(db: Session, device_id: str) -> type[models.Device] | None:
     return db.query(models.Device).filter(models.Device.id == device_id).first()
 
 
-def create_clipboard_item(db: Session, item: schemas.ClipboardItemCreate, user_id: str,
-                          device_id: str) -> models.ClipboardItem:
-    content_hash = ''
-    if item.type == 'text':
-        content_hash = hashlib.md5(item.data.encode('utf-8')).hexdigest()
-
-    db_item = models.ClipboardItem(
-        user_id=user_id,
-        device_id=device_id,
-        item_type=item.type,
-        content=item.data,
-        content_hash=content_hash,  # 计算内容md5哈希
-        meta_data=item.meta,
-        is_compressed=True if item.type == 'text' else False
+def text_hash(data: str | None) -> str:
+    """文本内容的md5哈希"""
+    if not data:
+        return ''
+    return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
+def get_item_expires_at(item_type: str) -> datetime | None:
+    """按类型的保留天数计算过期时间，0 表示永久保留"""
+    retention_days = {
+        'text': settings.RETENTION_TEXT_DAYS,
+        'image': settings.RETENTION_IMAGE_DAYS,
+        'file': settings.RETENTION_FILE_DAYS,
+    }.get(item_type, 0)
+    if retention_days <= 0:
+        return None
+    return datetime.now(timezone.utc) + timedelta(days=retention_days)
+
+
+def delete_clipboard_items(db: Session, item_ids: list[int]) -> list[str]:
+    """删除条目并释放其引用的 blob（不提交），返回被释放引用的文件哈希"""
+    if not item_ids:
+        return []
+    file_hashes = [row.content_hash for row in db.query(models.ClipboardItem.content_hash).filter(
+        models.ClipboardItem.id.in_(item_ids),
+        models.ClipboardItem.item_type.in_(('image', 'file'))
+    ).all()]
+    search_index.remove_items(db, item_ids)
+    db.execute(delete(models.ClipboardItem).where(models.ClipboardItem.id.in_(item_ids)))
+    release_blob_references(db, file_hashes)
+    return file_hashes
+
+
+def get_file_item(db: Session, user_id: str, content_hash: str | None = None,
+                  url: str | None = None) -> type[models.ClipboardItem] | None:
+    """查找用户拥有的文件条目，blob 文件按哈希查找，旧版文件按 URL 查找"""
+    query = db.query(models.ClipboardItem).filter(
+        models.ClipboardItem.user_id == user_id,
+        models.ClipboardItem.item_type.in_(('image', 'file'))
     )
-    db.add(db_item)
-    db.commit()
-    db.refresh(db_item)
-    return db_item
+    if content_hash:
+        query = query.filter(models.ClipboardItem.content_hash == content_hash)
+    else:
+        query = query.filter(models.ClipboardItem.content == url)
+    return query.order_by(models.ClipboardItem.id.desc()).first()
 
 
 def get_sync_state(db: Session, user_id: str, device_id: str) -> type[models.SyncState] | None:
@@ -102,3 +132,42 @@ def get_clipboard_items_since(db: Session, user_id: str, last_version: int, limi
         models.ClipboardItem.user_id == user_id,
         models.ClipboardItem.id > last_version
     ).order_by(models.ClipboardItem.id.asc()).limit(limit).all()
+
+
+def release_blob_references(db: Session, content_hashes: list[str]):
+    """按被删除的条目减少引用计数（不提交），同一哈希出现几次就减几次"""
+    counts: dict[str, int] = {}
+    for content_hash in content_hashes:
+        if content_hash:
+            counts[content_hash] = counts.get(content_hash, 0) + 1
+    for content_hash, count in counts.items():
+        db.execute(
+            update(models.Blob).where(models.Blob.hash == content_hash).values(ref_count=models.Blob.ref_count - count)
+        )
+
+
+def delete_unreferenced_blobs(db: Session, content_hashes: list[str] | None = None) -> list[str]:
+    """删除引用计数为0的 blob 记录并提交，返回被删除的哈希，调用方负责删除对应文件"""
+    query = db.query(models.Blob.hash).filter(models.Blob.ref_count <= 0)
+    if content_hashes is not None:
+        query = query.filter(models.Blob.hash.in_(content_hashes))
+    removed = []
+    for row in query.all():
+        # 逐条按 ref_count 条件删除，期间被重新引用的 blob 不会被误删
+        result = db.execute(delete(models.Blob).where(models.Blob.hash == row.hash, models.Blob.ref_count <= 0))
+        if result.rowcount:
+            removed.append(row.hash)
+    db.commit()
+    return removed
+
+
+def revoke_device_tokens(db: Session, device_id: str, expires_at: datetime) -> list[str]:
+    """吊销设备所有登录的令牌 family 并删除其刷新令牌（不提交），返回吊销的 family"""
+    family_ids = [row.family_id for row in db.query(models.RefreshToken.family_id).filter(
+        models.RefreshToken.device_id == device_id
+    ).distinct().all()]
+    db.add_all(models.TokenRevocation(family_id=family_id, expires_at=expires_at) for family_id in family_ids)
+    db.query(models.RefreshToken).filter(
+        models.RefreshToken.device_id == device_id
+    ).delete(synchronize_session=False)
+    return family_ids
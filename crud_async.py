@@ -0,0 +1,265 @@
+"""
+crud 中热点操作的异步版本
+供 async def 接口和 WebSocket 使用，数据库往返期间不阻塞事件循环
+"""
+import uuid
+from datetime import datetime
+
+from sqlalchemy import case, delete, func, select, update
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import compression
+import crud
+import models
+import schemas
+import search_index
+
+
+async def get_user(db: AsyncSession, user_id: str) -> models.User | None:
+    return await db.scalar(select(models.User).where(models.User.id == user_id))
+
+
+async def get_user_by_email(db: AsyncSession, email: str) -> models.User | None:
+    return await db.scalar(select(models.User).where(models.User.email == email))
+
+
+async def create_user(db: AsyncSession, email: str, password_hash: str) -> models.User:
+    db_user = models.User(
+        id=str(uuid.uuid4()),
+        email=email,
+        password_hash=password_hash
+    )
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    return db_user
+
+
+async def get_or_create_device(db: AsyncSession, user_id: str, device_id: str, device_name: str, device_type: str,
+                               is_active=False) -> models.Device:
+    """查询设备并更新在线状态，不存在时创建（不提交）"""
+    existing_device = await get_device(db, device_id)
+    if existing_device:
+        existing_device.is_active = is_active
+        return existing_device
+
+    db_device = models.Device(
+        id=device_id,
+        user_id=user_id,
+        name=device_name,
+        type=device_type,
+        is_active=is_active
+    )
+    db.add(db_device)
+    return db_device
+
+
+async def get_device(db: AsyncSession, device_id: str) -> models.Device | None:
+    return await db.scalar(select(models.Device).where(models.Device.id == device_id))
+
+
+async def get_user_device(db: AsyncSession, user_id: str, device_id: str) -> models.Device | None:
+    return await db.scalar(select(models.Device).where(
+        models.Device.id == device_id,
+        models.Device.user_id == user_id
+    ))
+
+
+async def set_devices_last_active(db: AsyncSession, last_active: dict[str, datetime]):
+    """按设备写入各自的最后活动时间（不提交），一条 UPDATE ... SET last_active = CASE id ... END"""
+    await db.execute(update(models.Device).where(
+        models.Device.id.in_(list(last_active))
+    ).values(last_active=case(last_active, value=models.Device.id)))
+
+
+async def set_devices_active(db: AsyncSession, device_ids: list[str], is_active: bool, last_active: datetime):
+    """批量写入设备在线状态（不提交）"""
+    await db.execute(update(models.Device).where(
+        models.Device.id.in_(device_ids)
+    ).values(is_active=is_active, last_active=last_active))
+
+
+async def get_sync_state(db: AsyncSession, user_id: str, device_id: str) -> models.SyncState | None:
+    return await db.scalar(select(models.SyncState).where(
+        models.SyncState.user_id == user_id,
+        models.SyncState.device_id == device_id
+    ))
+
+
+async def upsert_sync_state(db: AsyncSession, user_id: str, device_id: str, last_synced_id: int):
+    """记录设备已同步到的条目 id，只前进不后退（不提交）"""
+    values = {"user_id": user_id, "device_id": device_id, "last_synced_id": last_synced_id}
+    dialect = db.bind.dialect.name
+    if dialect == "mysql":
+        statement = mysql.insert(models.SyncState).values(**values)
+        statement = statement.on_duplicate_key_update(
+            last_synced_id=func.greatest(models.SyncState.last_synced_id, statement.inserted.last_synced_id),
+            last_sync=func.now()
+        )
+    else:
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        # SQLite 的双参数 max() 与 greatest 相同
+        greatest = func.greatest if dialect == "postgresql" else func.max
+        statement = insert(models.SyncState).values(**values)
+        statement = statement.on_conflict_do_update(
+            index_elements=[models.SyncState.user_id, models.SyncState.device_id],
+            set_={
+                "last_synced_id": greatest(models.SyncState.last_synced_id, statement.excluded.last_synced_id),
+                "last_sync": func.now(),
+            }
+        )
+    await db.execute(statement)
+
+
+async def get_latest_version(db: AsyncSession, user_id: str) -> int:
+    return await db.scalar(select(func.max(models.ClipboardItem.id)).where(
+        models.ClipboardItem.user_id == user_id
+    )) or 0
+
+
+async def get_user_clipboard_item(db: AsyncSession, user_id: str, item_id: int) -> models.ClipboardItem | None:
+    return await db.scalar(select(models.ClipboardItem).where(
+        models.ClipboardItem.id == item_id,
+        models.ClipboardItem.user_id == user_id
+    ))
+
+
+async def get_previous_text_item(db: AsyncSession, user_id: str, before_id: int) -> models.ClipboardItem | None:
+    """用户在 before_id 之前的最后一条文本条目"""
+    return await db.scalar(select(models.ClipboardItem).where(
+        models.ClipboardItem.user_id == user_id,
+        models.ClipboardItem.id < before_id,
+        models.ClipboardItem.item_type == "text"
+    ).order_by(models.ClipboardItem.id.desc()).limit(1))
+
+
+async def get_clipboard_items_since(db: AsyncSession, user_id: str, last_version: int,
+                                    limit: int = 50) -> list[models.ClipboardItem]:
+    """按 (user_id, id) 索引向后翻页"""
+    result = await db.scalars(select(models.ClipboardItem).where(
+        models.ClipboardItem.user_id == user_id,
+        models.ClipboardItem.id > last_version
+    ).order_by(models.ClipboardItem.id.asc()).limit(limit))
+    return list(result.all())
+
+
+async def get_clipboard_history(db: AsyncSession, user_id: str, item_type: str | None = None,
+                                device_id: str | None = None, since: datetime | None = None,
+                                until: datetime | None = None, search: str | None = None,
+                                before_id: int | None = None, limit: int = 50) -> list[models.ClipboardItem]:
+    """按 id 倒序分页查询历史，before_id 为上一页最后一条的 id"""
+    statement = select(models.ClipboardItem).where(models.ClipboardItem.user_id == user_id)
+    if before_id is not None:
+        statement = statement.where(models.ClipboardItem.id < before_id)
+    if item_type:
+        statement = statement.where(models.ClipboardItem.item_type == item_type)
+    if device_id:
+        statement = statement.where(models.ClipboardItem.device_id == device_id)
+    if since:
+        statement = statement.where(models.ClipboardItem.created_at >= since)
+    if until:
+        statement = statement.where(models.ClipboardItem.created_at < until)
+    if search:
+        statement = statement.where(models.ClipboardItem.id.in_(search_index.match_clause(user_id, search)))
+    result = await db.scalars(statement.order_by(models.ClipboardItem.id.desc()).limit(limit))
+    return list(result.all())
+
+
+async def add_blob_reference(db: AsyncSession, content_hash: str, size: int):
+    """增加 blob 的引用计数，不存在时创建记录（不提交）"""
+    statement = update(models.Blob).where(models.Blob.hash == content_hash).values(
+        ref_count=models.Blob.ref_count + 1)
+    result = await db.execute(statement)
+    if result.rowcount:
+        return
+    try:
+        # 并发上传同一内容时可能已被其他请求插入
+        async with db.begin_nested():
+            db.add(models.Blob(hash=content_hash, size=size, ref_count=1))
+    except IntegrityError:
+        await db.execute(statement)
+
+
+async def create_clipboard_item(db: AsyncSession, item: schemas.ClipboardItemCreate, user_id: str,
+                                device_id: str) -> models.ClipboardItem:
+    content_hash = item.hash or crud.text_hash(item.data)
+
+    if item.hash and item.type in ('image', 'file'):
+        await add_blob_reference(db, item.hash, (item.meta or {}).get('size') or 0)
+
+    compressed = compression.compress_text(item.data) if item.type == 'text' else None
+
+    db_item = models.ClipboardItem(
+        user_id=user_id,
+        device_id=device_id,
+        item_type=item.type,
+        content=item.data if compressed is None else None,
+        content_compressed=compressed,
+        content_hash=content_hash,  # 文本为md5，文件为sha256
+        meta_data=item.meta,
+        is_compressed=compressed is not None,
+        expires_at=crud.get_item_expires_at(item.type)
+    )
+    db.add(db_item)
+    # 全文索引与条目在同一事务中写入
+    await db.flush()
+    await search_index.index_item(db, db_item, item.data)
+    await db.commit()
+    await db.refresh(db_item)
+    return db_item
+
+
+async def create_refresh_token(db: AsyncSession, jti: str, family_id: str, user_id: str, device_id: str,
+                               expires_at: datetime):
+    """记录签发的刷新令牌（不提交）"""
+    db.add(models.RefreshToken(jti=jti, family_id=family_id, user_id=user_id, device_id=device_id,
+                               expires_at=expires_at))
+
+
+async def get_refresh_token(db: AsyncSession, jti: str) -> models.RefreshToken | None:
+    return await db.scalar(select(models.RefreshToken).where(models.RefreshToken.jti == jti))
+
+
+async def mark_refresh_token_used(db: AsyncSession, jti: str, used_at: datetime) -> bool:
+    """标记刷新令牌已轮换（不提交），令牌已被使用过时返回 False"""
+    result = await db.execute(update(models.RefreshToken).where(
+        models.RefreshToken.jti == jti,
+        models.RefreshToken.used_at.is_(None)
+    ).values(used_at=used_at))
+    return result.rowcount == 1
+
+
+async def add_used_refresh_token(db: AsyncSession, jti: str, family_id: str, user_id: str, device_id: str,
+                                 expires_at: datetime, used_at: datetime) -> bool:
+    """记录升级前签发、没有登记过的刷新令牌已被使用（不提交），并发使用同一令牌时只有一个请求返回 True"""
+    try:
+        async with db.begin_nested():
+            db.add(models.RefreshToken(jti=jti, family_id=family_id, user_id=user_id, device_id=device_id,
+                                       expires_at=expires_at, used_at=used_at))
+    except IntegrityError:
+        return False
+    return True
+
+
+async def revoke_token_families(db: AsyncSession, family_ids: list[str], expires_at: datetime):
+    """记录吊销的令牌 family（不提交）"""
+    db.add_all(models.TokenRevocation(family_id=family_id, expires_at=expires_at) for family_id in family_ids)
+
+
+async def get_token_revocations_since(db: AsyncSession, after_id: int, now: datetime,
+                                      limit: int = 1000) -> list[models.TokenRevocation]:
+    """id 在 after_id 之后且尚未过期的吊销记录"""
+    result = await db.scalars(select(models.TokenRevocation).where(
+        models.TokenRevocation.id > after_id,
+        models.TokenRevocation.expires_at > now
+    ).order_by(models.TokenRevocation.id.asc()).limit(limit))
+    return list(result.all())
+
+
+async def delete_expired_tokens(db: AsyncSession, now: datetime) -> int:
+    """删除已过期的刷新令牌和吊销记录（不提交）"""
+    refresh_tokens = await db.execute(delete(models.RefreshToken).where(models.RefreshToken.expires_at <= now))
+    revocations = await db.execute(delete(models.TokenRevocation).where(models.TokenRevocation.expires_at <= now))
+    return refresh_tokens.rowcount + revocations.rowcount
@@ -1,6 +1,8 @@
-from contextlib import contextmanager
+from contextlib import contextmanager, asynccontextmanager
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from config import settings
@@ -18,9 +20,56 @@ engine = create_engine(SQLALCHEMY_DATABASE_URL,
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# 异步驱动对应关系，供 async def 接口使用，避免数据库往返阻塞事件循环
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "mysql": "mysql+aiomysql",
+}
+
+
+def get_async_database_url(url: str) -> str:
+    """把同步连接串转换为对应的异步驱动连接串，如 mysql+pymysql -> mysql+aiomysql"""
+    database_url = make_url(url)
+    backend = database_url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for database backend: {backend}")
+    return database_url.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+
+async_engine = create_async_engine(get_async_database_url(SQLALCHEMY_DATABASE_URL),
+                                   pool_recycle=3600,
+                                   pool_pre_ping=True,
+                                   pool_size=20,
+                                   max_overflow=5,
+                                   pool_timeout=10,
+                                   pool_use_lifo=True)
+# 提交后不过期属性，后台任务在会话关闭后仍可读取条目
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
 
 def create_db():
     Base.metadata.create_all(bind=engine)
+    upgrade_db()
+
+
+def upgrade_db():
+    """为已存在的表补齐后续新增的列和索引（create_all 只会创建缺失的表）"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                # 新增的列都是可空列，直接追加即可
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn)
 
 
 def get_db():
@@ -34,6 +83,14 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    """
+    return: async db session
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 @contextmanager
 def get_db_context() -> Session:
     """Context manager for manual database session management"""
@@ -45,3 +102,14 @@ def get_db_context() -> Session:
         raise
     finally:
         db.close()
+
+
+@asynccontextmanager
+async def get_async_db_context() -> AsyncSession:
+    """Async context manager for manual database session management"""
+    async with AsyncSessionLocal() as db:
+        try:
+            yield db
+        except Exception:
+            await db.rollback()
+            raise
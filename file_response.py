@@ -0,0 +1,112 @@
+"""
+剪贴板文件下载响应
+支持 ETag/Last-Modified 条件请求与 Range 断点续传；配置 SENDFILE_HEADER 后
+由前置的 Nginx（X-Accel-Redirect）或 Apache/Lighttpd（X-Sendfile）以零拷贝 sendfile 发送文件。
+大文本条目的全文同样以内容哈希作为 ETag 返回
+"""
+import os
+from datetime import timezone
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional
+from urllib.parse import quote
+
+from fastapi import Request
+from starlette.responses import FileResponse, Response
+
+from config import settings
+from file_storage import UPLOAD_DIR
+
+# 内容寻址的文件永远不会变化，可以被客户端长期缓存
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+DEFAULT_CACHE_CONTROL = "private, max-age=86400"
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in candidates
+
+
+def _not_modified_since(if_modified_since: str, mtime: float) -> bool:
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    # HTTP 日期只精确到秒
+    return int(mtime) <= since.timestamp()
+
+
+def _content_disposition(filename: str, disposition_type: str) -> str:
+    quoted_filename = quote(filename)
+    if quoted_filename != filename:
+        return f"{disposition_type}; filename*=utf-8''{quoted_filename}"
+    return f'{disposition_type}; filename="{filename}"'
+
+
+def build_file_response(request: Request, path: str, content_hash: Optional[str], filename: Optional[str],
+                        content_type: Optional[str], immutable: bool) -> Response:
+    """
+    构造文件下载响应
+
+    Args:
+        request: 当前请求，用于读取条件请求头
+        path: 文件在磁盘上的路径
+        content_hash: 内容哈希，作为强 ETag
+        filename: 下载时的文件名
+        content_type: 文件 MIME 类型
+        immutable: 文件是否按内容寻址（可长期缓存）
+    """
+    stat_result = os.stat(path)
+    etag = f'"{content_hash}"' if content_hash else None
+    headers = {
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else DEFAULT_CACHE_CONTROL,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+    }
+    if etag:
+        headers["ETag"] = etag
+
+    # If-None-Match 优先于 If-Modified-Since（RFC 9110 13.2.2）
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if etag and _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+    else:
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since and _not_modified_since(if_modified_since, stat_result.st_mtime):
+            return Response(status_code=304, headers=headers)
+
+    disposition_type = "inline" if content_type and content_type.startswith("image/") else "attachment"
+
+    if settings.SENDFILE_HEADER:
+        # 交给前置服务器发送文件，Range 也由其处理
+        internal_path = os.path.relpath(path, UPLOAD_DIR).replace(os.sep, "/")
+        headers[settings.SENDFILE_HEADER] = f"{settings.SENDFILE_PREFIX.rstrip('/')}/{internal_path}"
+        if filename:
+            headers["Content-Disposition"] = _content_disposition(filename, disposition_type)
+        return Response(media_type=content_type or "application/octet-stream", headers=headers)
+
+    # FileResponse 处理 Range/If-Range，ASGI 服务器支持 http.response.pathsend 扩展时不经过 Python 读文件
+    return FileResponse(path, headers=headers, media_type=content_type, filename=filename,
+                        stat_result=stat_result, content_disposition_type=disposition_type)
+
+
+def build_text_response(request: Request, content: str, content_hash: Optional[str]) -> Response:
+    """
+    构造文本条目全文的响应，条目内容不会变化，可以被客户端长期缓存
+
+    Args:
+        request: 当前请求，用于读取 If-None-Match
+        content: 文本内容
+        content_hash: 内容哈希，作为强 ETag
+    """
+    headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    if content_hash:
+        etag = f'"{content_hash}"'
+        headers["ETag"] = etag
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None and _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+    return Response(content, media_type="text/plain; charset=utf-8", headers=headers)
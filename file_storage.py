@@ -0,0 +1,88 @@
+"""
+上传文件存储
+以固定大小的分块读写上传内容，在同一次遍历中计算内容哈希并限制文件大小，
+磁盘读写放在线程池中执行，不阻塞事件循环
+"""
+import hashlib
+import os
+import threading
+import uuid
+from dataclasses import dataclass
+from typing import BinaryIO, Optional
+
+from config import settings
+
+UPLOAD_DIR = "uploads"
+CHUNK_SIZE = settings.UPLOAD_CHUNK_SIZE_KB * 1024
+
+
+class UploadTooLargeError(Exception):
+    """上传内容超过 MAX_UPLOAD_SIZE_MB 限制"""
+
+
+class UploadAbortedError(Exception):
+    """上传在写入过程中被取消（例如客户端断开）"""
+
+
+@dataclass
+class SavedFile:
+    path: str
+    size: int
+    content_hash: str  # sha256 十六进制
+    # 引用提交前 blob 被删除时用于恢复的内容，见 blob_store.finish_store：
+    staging_path: Optional[str] = None  # 续传上传的临时文件
+    source: Optional[BinaryIO] = None  # 直接上传时仍然打开的上传文件
+
+
+def max_upload_size() -> int:
+    return settings.MAX_UPLOAD_SIZE_MB * 1024 * 1024
+
+
+def hash_stream(src: BinaryIO, max_size: int, cancelled: threading.Event) -> tuple[int, str]:
+    """
+    分块读取 src 计算 (大小, sha256)，不产生任何写入
+
+    Raises:
+        UploadTooLargeError: 读取的字节数超过 max_size
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    while True:
+        if cancelled.is_set():
+            raise UploadAbortedError()
+        chunk = src.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_size:
+            raise UploadTooLargeError()
+        hasher.update(chunk)
+    return size, hasher.hexdigest()
+
+
+def copy_stream(src: BinaryIO, dst_path: str, max_size: int, cancelled: threading.Event) -> int:
+    """
+    分块复制 src 到 dst_path，返回大小（哈希已由 hash_stream 计算，复制时不再计算）
+
+    先写入 .part 临时文件，完成后再原子重命名，任何异常都会删除临时文件
+    """
+    tmp_path = f"{dst_path}.{uuid.uuid4().hex}.part"
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            while True:
+                if cancelled.is_set():
+                    raise UploadAbortedError()
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLargeError()
+                f.write(chunk)
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return size
@@ -0,0 +1,122 @@
+"""
+WebSocket 心跳
+连接空闲超过心跳间隔时服务器发送 {"action": "heartbeat"}，客户端收到后回复任意消息即可；
+发送心跳后超过 WS_HEARTBEAT_TIMEOUT_SECONDS 仍未收到消息的连接（如休眠设备留下的半开连接）会被断开。
+所有连接的检查时间放在同一个最小堆里，由一个后台任务处理，不为每个连接创建任务
+"""
+import asyncio
+import heapq
+import itertools
+import json
+from typing import Optional
+
+import log
+from config import settings
+from connection_manager import Connection
+from ws_codec import EncodedMessage
+
+# 心跳超时断开，客户端应重连并同步遗漏的内容
+WS_CLOSE_HEARTBEAT_TIMEOUT = 4408
+
+# 所有连接共享同一条心跳消息的编码结果
+HEARTBEAT_MESSAGE = EncodedMessage({"action": "heartbeat"})
+
+
+def negotiate_interval(requested) -> int:
+    """客户端请求的心跳间隔限制在允许范围内，无效时使用默认值"""
+    try:
+        interval = int(requested)
+    except (TypeError, ValueError):
+        return settings.WS_HEARTBEAT_INTERVAL_SECONDS
+    return max(settings.WS_HEARTBEAT_MIN_INTERVAL_SECONDS, min(interval, settings.WS_HEARTBEAT_MAX_INTERVAL_SECONDS))
+
+
+class HeartbeatScheduler:
+    """按检查时间排序的心跳调度器，stats 记录心跳和断开的连接数"""
+
+    def __init__(self):
+        # (检查时间, 序号, 连接, 心跳代数)，代数变化或连接已关闭的条目出堆时直接丢弃
+        self._heap: list[tuple[float, int, Connection, int]] = []
+        self._counter = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "heartbeats_sent": 0,
+            "connections_reaped": 0,
+        }
+
+    def add(self, connection: Connection, interval=None) -> int:
+        """
+        开始（或按新的间隔重新）检查连接
+
+        Returns:
+            协商后的心跳间隔（秒）
+        """
+        negotiated = negotiate_interval(interval)
+        connection.heartbeat_interval = float(negotiated)
+        connection.heartbeat_generation += 1
+        self._push(connection, connection.last_seen + negotiated)
+        # 告知客户端实际使用的心跳参数
+        connection.enqueue(json.dumps({
+            "action": "heartbeat",
+            "interval": negotiated,
+            "timeout": settings.WS_HEARTBEAT_TIMEOUT_SECONDS,
+        }))
+        return negotiated
+
+    def _push(self, connection: Connection, deadline: float):
+        entry = (deadline, next(self._counter), connection, connection.heartbeat_generation)
+        heapq.heappush(self._heap, entry)
+        if self._wakeup and self._heap[0] is entry:
+            # 新条目比当前等待的更早到期
+            self._wakeup.set()
+
+    def _check(self, connection: Connection, now: float):
+        timeout = settings.WS_HEARTBEAT_TIMEOUT_SECONDS
+        idle = now - connection.last_seen
+        if idle >= connection.heartbeat_interval + timeout:
+            self.stats["connections_reaped"] += 1
+            log.info(f'Heartbeat timeout, reap user:{connection.user_id} device:{connection.device_id}')
+            connection.close_soon(WS_CLOSE_HEARTBEAT_TIMEOUT, "heartbeat timeout")
+        elif idle >= connection.heartbeat_interval:
+            if connection.pinged_at < connection.last_seen:
+                connection.pinged_at = now
+                if connection.enqueue(HEARTBEAT_MESSAGE):
+                    self.stats["heartbeats_sent"] += 1
+            self._push(connection, connection.last_seen + connection.heartbeat_interval + timeout)
+        else:
+            self._push(connection, connection.last_seen + connection.heartbeat_interval)
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            while self._heap and self._heap[0][0] <= now:
+                _, _, connection, generation = heapq.heappop(self._heap)
+                if connection.closed or generation != connection.heartbeat_generation:
+                    continue
+                try:
+                    self._check(connection, now)
+                except Exception as e:
+                    log.error(f'Heartbeat check failed: {e}', exc_info=True)
+
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self._heap.clear()
+
+
+# 全局心跳调度实例
+heartbeats = HeartbeatScheduler()
@@ -0,0 +1,88 @@
+"""
+每个用户最新剪贴板条目的内存缓存
+剪贴板监听程序经常对同一内容重复触发上传，内容哈希与用户最新条目相同时
+直接返回已有条目，不写数据库也不通知其他设备
+"""
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi.encoders import jsonable_encoder
+
+from config import settings
+
+
+@dataclass
+class LatestItem:
+    item_id: int
+    item_type: str
+    content_hash: str
+    response: dict  # 上传接口返回给客户端的内容
+    expires_at: Optional[datetime] = None
+
+    def to_dict(self) -> dict:
+        """转为可 JSON 序列化的字典，用于通过消息总线同步给其他 worker"""
+        return {
+            "item_id": self.item_id,
+            "item_type": self.item_type,
+            "content_hash": self.content_hash,
+            "response": jsonable_encoder(self.response),
+            "expires_at": self.expires_at.isoformat() if self.expires_at else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LatestItem":
+        expires_at = data.get("expires_at")
+        return cls(
+            item_id=data["item_id"],
+            item_type=data["item_type"],
+            content_hash=data["content_hash"],
+            response=data["response"],
+            expires_at=datetime.fromisoformat(expires_at) if expires_at else None,
+        )
+
+
+class LatestItemCache:
+    """按用户保存最新条目，超过容量时淘汰最久未更新的用户"""
+
+    def __init__(self, max_users: int):
+        self._items: OrderedDict[str, LatestItem] = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_users = max_users
+        self.stats = {"hits": 0, "misses": 0}
+
+    def match(self, user_id: str, item_type: str, content_hash: str) -> Optional[LatestItem]:
+        """内容与用户最新条目相同时返回该条目"""
+        with self._lock:
+            latest = self._items.get(user_id)
+            if latest and latest.expires_at and latest.expires_at <= datetime.now(timezone.utc):
+                # 条目已过期，可能已被清理
+                del self._items[user_id]
+                latest = None
+            if latest and latest.item_type == item_type and latest.content_hash == content_hash:
+                self.stats["hits"] += 1
+                return latest
+            self.stats["misses"] += 1
+            return None
+
+    def remember(self, user_id: str, item: LatestItem):
+        with self._lock:
+            if item.expires_at and item.expires_at.tzinfo is None:
+                item.expires_at = item.expires_at.replace(tzinfo=timezone.utc)
+            current = self._items.get(user_id)
+            if current and current.item_id > item.item_id:
+                return
+            self._items[user_id] = item
+            self._items.move_to_end(user_id)
+            while len(self._items) > self._max_users:
+                self._items.popitem(last=False)
+
+    def forget(self, user_id: str):
+        with self._lock:
+            self._items.pop(user_id, None)
+
+
+# 全局最新条目缓存实例
+latest_items = LatestItemCache(settings.LATEST_ITEM_CACHE_MAX_USERS)
@@ -1,20 +1,47 @@
+import asyncio
+import hashlib
 import mimetypes
 import os
+import uuid
 from datetime import datetime, timedelta, timezone
 
 import uvicorn
 from fastapi import FastAPI, HTTPException, status, Depends, WebSocket, WebSocketDisconnect, BackgroundTasks, \
-    UploadFile, Form, File, Header, Query
+    UploadFile, Form, File, Header, Query, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse
-from jose import jwt, JWTError
+from jose import JWTError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from starlette.responses import JSONResponse
 
 import crud
+import crud_async
 from config import settings
-from connection_manager import ConnectionManager
-from database import get_db, create_db, get_db_context
+from connection_manager import manager
+from database import get_db, get_async_db, get_async_db_context
+from file_response import build_file_response, build_text_response
+from file_storage import UPLOAD_DIR, SavedFile, UploadTooLargeError
+from upload_session import UploadSessionError, upload_sessions
+from upload_limit import UploadLimitMiddleware
+from retention import retention_sweeper
+from latest_item_cache import LatestItem, latest_items
+from auth_cache import auth_cache
+from token_cache import verified_tokens
+from token_revocation import family_revocation_expiry, token_revocations
+from password_hasher import PasswordHasherBusy, password_hasher
+from backplane import backplane
+from notify_coalescer import notify_coalescer
+from presence import presence
+from heartbeat import heartbeats
+from sync_payload import build_sync_payload, content_fields
+from replay import replay_missed_items
+from ws_codec import EncodedMessage
+import blob_store
+import migrate
+import search_index
+import text_delta
+import ws_codec
 import models
 import auth
 import schemas
@@ -22,25 +49,11 @@ import log
 import email_service
 from verification_code_cache import code_cache
 
-UPLOAD_DIR = "uploads"
-
-
-def save_upload_file(file: UploadFile) -> str:
-    if not os.path.exists(UPLOAD_DIR):
-        os.makedirs(UPLOAD_DIR)
-    safe_name = os.path.basename(file.filename or "unknown")
-    ext = os.path.splitext(safe_name)[-1].lower()
-    filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}{ext}"
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    with open(file_path, "wb") as f:
-        f.write(file.file.read())
-    return file_path
-
 
 def get_file_url(file_path: str) -> str:
     # 假设静态文件通过 /files/ 访问
-    filename = os.path.basename(file_path)
-    return f"/files/{filename}"
+    relative_path = os.path.relpath(file_path, UPLOAD_DIR).replace(os.sep, "/")
+    return f"/files/{relative_path}"
 
 
 # FastAPI应用
@@ -50,26 +63,48 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# 挂载静态文件
-app.mount("/files", StaticFiles(directory="uploads", check_dir=False), name="files")
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
-# WebSocket连接管理器
-manager = ConnectionManager()
+# 上传文件在读取请求体之前按 Content-Length 限制大小
+app.add_middleware(UploadLimitMiddleware, paths=("/clipboard",))
 
+# 挂载静态文件（上传的文件通过需要鉴权的 /files 路由下载）
+app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # 应用程序启动前运行
 @app.on_event("startup")
-def on_startup():
+async def on_startup():
     log.setup_logging()
 
-    # 创建数据库表
-    create_db()
+    # 创建数据库表和历史搜索索引表，多 worker 部署时改为启动前执行 python migrate.py
+    if settings.DB_AUTO_UPGRADE:
+        migrate.upgrade()
+    # 加载令牌吊销记录并定期增量同步
+    await token_revocations.start()
+
+    # 启动过期上传会话清理
+    upload_sessions.start()
+    # 启动过期条目清理
+    retention_sweeper.start()
+    # 启动设备在线状态写回
+    presence.start()
+    # 启动WebSocket心跳检查
+    heartbeats.start()
+    # 连接消息总线，接收其他 worker 发布的通知
+    backplane.set_handler(handle_backplane_event)
+    await backplane.start()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """应用关闭事件"""
+    await upload_sessions.stop()
+    await retention_sweeper.stop()
+    # 先发布合并窗口中等待的通知，再关闭消息总线
+    await notify_coalescer.stop()
+    await backplane.stop()
+    await heartbeats.stop()
+    await presence.stop()
+    await token_revocations.stop()
+    password_hasher.shutdown()
     log.info('App was shut down')
 
 
@@ -109,34 +144,79 @@ async def test_fingerprint():
     return read_html("static/test_fingerprint.html")
 
 
-def create_token(user_id: str, device_id: str) -> tuple[str, str]:
+# 运行指标
+@app.get("/metrics")
+async def metrics():
+    """后台任务的运行指标，用于调优；包含连接数和用户数，需要开启 METRICS_ENABLED"""
+    if not settings.METRICS_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    return {
+        "retention": retention_sweeper.stats,
+        "duplicate_uploads": latest_items.stats,
+        "auth_cache": auth_cache.stats,
+        "jwt_cache": verified_tokens.get_stats(),
+        "token_revocation": token_revocations.stats,
+        "password_hash": password_hasher.get_stats(),
+        "websocket": manager.get_stats(),
+        "backplane": backplane.stats,
+        "notifications": notify_coalescer.stats,
+        "presence": presence.stats,
+        "heartbeat": heartbeats.stats,
+    }
+
+
+async def create_token(db: AsyncSession, user_id: str, device_id: str,
+                       family_id: str | None = None) -> tuple[str, str]:
+    """
+    签发访问令牌和刷新令牌（刷新令牌记录在数据库中，不提交）
+
+    每次登录开始一个新的令牌 family，刷新时轮换出的令牌沿用同一个 family，吊销时整个 family 一起失效
+    """
+    family_id = family_id or uuid.uuid4().hex
     # 创建访问令牌
     access_token_expires = timedelta(days=settings.ACCESS_TOKEN_EXPIRE_DAYS)
     a_token = auth.create_access_token(
-        data={"sub": user_id, "device_id": device_id},
+        data={"sub": user_id, "device_id": device_id, "fid": family_id},
         expires_delta=access_token_expires
     )
 
     # 创建刷新令牌
+    jti = uuid.uuid4().hex
     r_token = auth.create_refresh_token(
-        data={"sub": user_id, "device_id": device_id},
+        data={"sub": user_id, "device_id": device_id, "fid": family_id, "jti": jti},
     )
+    expires_at = datetime.now(timezone.utc) + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
+    await crud_async.create_refresh_token(db, jti, family_id, user_id, device_id, expires_at)
     return a_token, r_token
 
 
+async def revoke_token_families(db: AsyncSession, user_id: str, family_ids: list[str]):
+    """吊销令牌 family 并提交，通过消息总线立即通知所有 worker（包括本进程）"""
+    expires_at = family_revocation_expiry()
+    await crud_async.revoke_token_families(db, family_ids, expires_at)
+    await db.commit()
+    await backplane.publish({
+        "type": "revoke_families",
+        "user_id": user_id,
+        "families": family_ids,
+        "exp": expires_at.timestamp(),
+    })
+
+
 # 注册
 @app.post("/auth/register")
-def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def register(user: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
     # 检查邮箱是否已注册
-    existing_user = db.query(models.User).filter(models.User.email == user.email).first()
+    existing_user = await crud_async.get_user_by_email(db, email=user.email)
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email already registered"
         )
 
-    # 创建用户
-    db_user = crud.create_user(db, user)
+    # 创建用户（密码哈希在专用线程池中计算）
+    password_hash = await password_hasher.hash(user.password)
+    db_user = await crud_async.create_user(db, user.email, password_hash)
 
     if not db_user:
         raise HTTPException(
@@ -154,15 +234,23 @@ def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
 
 # 登录
 @app.post("/auth/login", response_model=schemas.Token)
-def login(user: schemas.UserLogin, db: Session = Depends(get_db)):
-    # 验证用户
-    db_user = crud.get_user_by_email(db, email=user.email)
-    if not db_user or not auth.verify_password(user.password, db_user.password_hash):
+async def login(user: schemas.UserLogin,
+                background_tasks: BackgroundTasks,
+                db: AsyncSession = Depends(get_async_db)):
+    # 验证用户（密码哈希在专用线程池中计算）
+    db_user = await crud_async.get_user_by_email(db, email=user.email)
+    if not db_user or not await password_hasher.verify(user.password, db_user.password_hash):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password"
         )
 
+    # BCRYPT_ROUNDS 调整后使用新的 cost 重新哈希
+    new_hash = await password_hasher.rehash_if_needed(user.password, db_user.password_hash)
+    if new_hash:
+        db_user.password_hash = new_hash
+        log.info(f"Rehashed password of user {db_user.email}")
+
     # 获取所有允许的设备类型
     allowed_types = ['ios', 'android', 'windows', 'macos', 'linux', 'web']
 
@@ -173,14 +261,16 @@ def login(user: schemas.UserLogin, db: Session = Depends(get_db)):
         )
 
     # 创建设备并激活设备
-    device = crud.get_or_create_device(db, user_id=db_user.id, device_id=user.device_id, device_name=user.device_name,
-                                       device_type=user.device_type, is_active=True)
+    device = await crud_async.get_or_create_device(db, user_id=db_user.id, device_id=user.device_id,
+                                                   device_name=user.device_name, device_type=user.device_type,
+                                                   is_active=True)
     # 更新用户的上线时间
     db_user.last_login = datetime.now(timezone.utc)
-    db.commit()
-
     # 创建令牌
-    access_token, refresh_token = create_token(db_user.id, device.id)
+    access_token, refresh_token = await create_token(db, db_user.id, device.id)
+    await db.commit()
+    # 认证缓存中可能还是退出登录后的离线状态
+    invalidate_device_auth(background_tasks, db_user.id, device.id)
 
     log.info(f"User {db_user.email} logged in")
 
@@ -252,13 +342,15 @@ def send_verification_code(request: schemas.SendVerificationCodeRequest, db: Ses
 
 # 验证码登录
 @app.post("/auth/login-with-code", response_model=schemas.Token)
-def login_with_code(request: schemas.VerifyCodeLoginRequest, db: Session = Depends(get_db)):
+async def login_with_code(request: schemas.VerifyCodeLoginRequest,
+                          background_tasks: BackgroundTasks,
+                          db: AsyncSession = Depends(get_async_db)):
     """使用验证码登录"""
     email = request.email
     code = request.code
 
     # 验证用户是否存在
-    db_user = crud.get_user_by_email(db, email=email)
+    db_user = await crud_async.get_user_by_email(db, email=email)
     if not db_user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -285,15 +377,15 @@ def login_with_code(request: schemas.VerifyCodeLoginRequest, db: Session = Depen
         )
 
     # 创建设备并激活设备
-    device = crud.get_or_create_device(db, user_id=db_user.id, device_id=request.device_id,
-                                       device_name=request.device_name,
-                                       device_type=request.device_type, is_active=True)
+    device = await crud_async.get_or_create_device(db, user_id=db_user.id, device_id=request.device_id,
+                                                   device_name=request.device_name,
+                                                   device_type=request.device_type, is_active=True)
     # 更新用户的上线时间
     db_user.last_login = datetime.now(timezone.utc)
-    db.commit()
-
     # 创建令牌
-    access_token, refresh_token = create_token(db_user.id, device.id)
+    access_token, refresh_token = await create_token(db, db_user.id, device.id)
+    await db.commit()
+    invalidate_device_auth(background_tasks, db_user.id, device.id)
 
     log.info(f"User {db_user.email} logged in with verification code")
 
@@ -305,14 +397,19 @@ def login_with_code(request: schemas.VerifyCodeLoginRequest, db: Session = Depen
 
 
 @app.post("/auth/refresh", response_model=schemas.Token)
-def refresh_token(refresh_token: str, db: Session = Depends(get_db)):
+async def refresh_token(refresh_token: str, db: AsyncSession = Depends(get_async_db)):
+    """
+    使用刷新令牌换取新的访问令牌和刷新令牌
+
+    刷新令牌只能使用一次，旧的刷新令牌再次使用时视为泄露，该次登录签发的所有令牌都被吊销，需要重新登录
+    """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate refresh token",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(refresh_token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        payload = verified_tokens.decode(refresh_token)
         user_id: str = payload.get("sub")
         device_id: str = payload.get("device_id")
         if user_id is None or device_id is None:
@@ -320,15 +417,37 @@ def refresh_token(refresh_token: str, db: Session = Depends(get_db)):
     except JWTError:
         raise credentials_exception
 
-    user = crud.get_user(db, user_id)
+    now = datetime.now(timezone.utc)
+    family_id = payload.get("fid")
+    if payload.get("type") == auth.REFRESH_TOKEN_TYPE and family_id:
+        stored = await crud_async.get_refresh_token(db, payload["jti"])
+        used = stored is not None and await crud_async.mark_refresh_token_used(db, stored.jti, now)
+    elif "type" not in payload and "fid" not in payload and "jti" not in payload:
+        # 升级前签发的刷新令牌：没有 type 和 family，也不在 refresh_tokens 中。
+        # 按令牌摘要登记为已使用并开始一个新的 family，只能换取一次，再次使用时吊销该 family
+        token_key = hashlib.sha256(refresh_token.encode("utf-8")).hexdigest()[:32]
+        stored = await crud_async.get_refresh_token(db, token_key)
+        family_id = uuid.uuid4().hex
+        used = stored is None and await crud_async.add_used_refresh_token(
+            db, token_key, family_id, user_id, device_id, datetime.fromtimestamp(payload["exp"], timezone.utc), now)
+    else:
+        # 访问令牌不能用于刷新
+        raise credentials_exception
+    if not used:
+        if stored:
+            # 已轮换过的刷新令牌再次出现，吊销整个 family
+            reused_family_id = stored.family_id
+            log.warning(f'Refresh token reuse detected. user:{user_id} device:{device_id} family:{reused_family_id}')
+            await db.rollback()
+            await revoke_token_families(db, user_id, [reused_family_id])
+        raise credentials_exception
+
+    user = await crud_async.get_user(db, user_id)
     if not user:
         raise credentials_exception
 
     # 获取当前设备
-    device = db.query(models.Device).filter(
-        models.Device.id == device_id,
-        models.Device.user_id == user_id
-    ).first()
+    device = await crud_async.get_user_device(db, user_id, device_id)
 
     if not device:
         raise HTTPException(
@@ -336,8 +455,9 @@ def refresh_token(refresh_token: str, db: Session = Depends(get_db)):
             detail="No active device found"
         )
 
-    # 创建新令牌
-    access_token, new_refresh_token = create_token(user_id, device.id)
+    # 轮换令牌，升级前签发的刷新令牌开始一个新的 family
+    access_token, new_refresh_token = await create_token(db, user_id, device.id, family_id)
+    await db.commit()
 
     return {
         "access_token": access_token,
@@ -346,6 +466,45 @@ def refresh_token(refresh_token: str, db: Session = Depends(get_db)):
     }
 
 
+# 退出登录
+@app.post("/auth/logout")
+async def logout(context: auth.AuthContext = Depends(auth.get_auth_context),
+                 current_device: models.Device = Depends(auth.get_current_device),
+                 db: AsyncSession = Depends(get_async_db)):
+    """退出当前设备：吊销本次登录的令牌，设备标记为离线，断开该设备的 WebSocket 连接并清除认证缓存"""
+    await crud_async.set_devices_active(db, [current_device.id], False, datetime.now(timezone.utc))
+    await db.commit()
+    if context.claims.get("fid"):
+        await revoke_token_families(db, current_device.user_id, [context.claims["fid"]])
+    elif context.claims.get("jti"):
+        await backplane.publish({
+            "type": "revoke_token",
+            "user_id": current_device.user_id,
+            "jti": context.claims["jti"],
+            "exp": context.claims["exp"],
+        })
+    await backplane.publish({
+        "type": "invalidate_device",
+        "user_id": current_device.user_id,
+        "device_id": current_device.id,
+        "disconnect": True,
+    })
+    log.info(f'Device {current_device.id} of user {current_device.user_id} logged out')
+    return {"code": 0, "message": "Logout successfully"}
+
+
+def invalidate_device_auth(background_tasks: BackgroundTasks, user_id: str, device_id: str,
+                           disconnect: bool = False):
+    """立即清除本进程中设备的认证缓存，其他 worker 通过消息总线清除"""
+    auth_cache.invalidate_device(user_id, device_id)
+    background_tasks.add_task(backplane.publish, {
+        "type": "invalidate_device",
+        "user_id": user_id,
+        "device_id": device_id,
+        "disconnect": disconnect,
+    })
+
+
 # 获取设备列表
 @app.get("/devices", response_model=list[schemas.DeviceBase])
 def get_devices(
@@ -355,12 +514,18 @@ def get_devices(
     devices = db.query(models.Device).filter(
         models.Device.user_id == current_user.id
     ).all()
-    return devices
+    # 数据库中的在线状态和最后活动时间是定期写回的快照，合并内存中的连接和请求记录
+    return [
+        schemas.DeviceBase.model_validate(device, from_attributes=True).model_copy(
+            update={"is_active": presence.is_online(device), "last_active": presence.last_active(device)})
+        for device in devices
+    ]
 
 
 @app.patch("/devices/{device_id}/rename")
 def rename_device(
         device_id: str,
+        background_tasks: BackgroundTasks,
         new_name: str = Query(..., min_length=1, max_length=50),
         current_user: models.User = Depends(auth.get_current_user),
         db: Session = Depends(get_db)
@@ -378,12 +543,14 @@ def rename_device(
 
     device.name = new_name
     db.commit()
+    invalidate_device_auth(background_tasks, current_user.id, device_id)
     return {"code": 0, "message": "Device renamed successfully"}
 
 
 @app.delete("/devices/{device_id}")
 def delete_device(
         device_id: str,
+        background_tasks: BackgroundTasks,
         current_user: models.User = Depends(auth.get_current_user),
         db: Session = Depends(get_db)
 ):
@@ -399,12 +566,39 @@ def delete_device(
         )
 
     # 先删除子表数据（外键约束所在表）
+    file_hashes = [row.content_hash for row in db.query(models.ClipboardItem.content_hash).filter(
+        models.ClipboardItem.device_id == device_id,
+        models.ClipboardItem.item_type.in_(("image", "file"))
+    ).all()]
+    search_index.remove_device_items(db, device_id)
     db.query(models.ClipboardItem).filter(
         models.ClipboardItem.device_id == device_id
     ).delete(synchronize_session=False)
+    crud.release_blob_references(db, file_hashes)
+    db.query(models.SyncState).filter(
+        models.SyncState.device_id == device_id
+    ).delete(synchronize_session=False)
     # 再删除父表数据
+    # 吊销设备所有登录签发的令牌
+    revocation_expires_at = family_revocation_expiry()
+    family_ids = crud.revoke_device_tokens(db, device_id, revocation_expires_at)
     db.delete(device)
     db.commit()
+    for family_id in family_ids:
+        verified_tokens.revoke_family(family_id, revocation_expires_at.timestamp())
+    if family_ids:
+        background_tasks.add_task(backplane.publish, {
+            "type": "revoke_families",
+            "user_id": current_user.id,
+            "families": family_ids,
+            "exp": revocation_expires_at.timestamp(),
+        })
+    invalidate_device_auth(background_tasks, current_user.id, device_id, disconnect=True)
+    # 用户的最新条目可能属于被删除的设备，其他 worker 也需要清除
+    latest_items.forget(current_user.id)
+    background_tasks.add_task(backplane.publish, {"type": "forget_latest", "user_id": current_user.id})
+    # 删除不再被引用的文件
+    blob_store.remove_blob_files(db, crud.delete_unreferenced_blobs(db, list(set(file_hashes))))
     return {"code": 0, "message": "Device delete successfully"}
 
 
@@ -416,14 +610,10 @@ async def upload_clipboard_item(background_tasks: BackgroundTasks,
                                 file: UploadFile = File(None),
                                 current_user: models.User = Depends(auth.get_current_user),
                                 current_device: models.Device = Depends(auth.get_current_active_device),
-                                db: Session = Depends(get_db)
+                                db: AsyncSession = Depends(get_async_db)
                                 ):
-    meta = {}
-    file_url: str = ''
-    content_type: str = ''
-
     if type in ("image", "file") and file:
-        # 检查文件大小
+        # 检查文件大小（file.size 可能为空，写入时会再按实际字节数校验）
         max_size = settings.MAX_UPLOAD_SIZE_MB * 1024 * 1024
         if file.size and file.size > max_size:
             raise HTTPException(
@@ -431,63 +621,337 @@ async def upload_clipboard_item(background_tasks: BackgroundTasks,
                 detail=f"File size exceeds {settings.MAX_UPLOAD_SIZE_MB}MB limit"
             )
 
-        file_path = save_upload_file(file)
-        file_url = get_file_url(file_path)
-
-        content = file_url
+        try:
+            saved_file = await blob_store.save_upload_file(file)
+        except UploadTooLargeError:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"File size exceeds {settings.MAX_UPLOAD_SIZE_MB}MB limit"
+            )
         content_type = file.content_type or mimetypes.guess_type(file.filename)[0]
-        meta = {
-            "filename": file.filename,
-            "content_type": content_type,
-            "size": file.size,
-        }
-        log.info(
-            f'Received image or file. file name:{file.filename} type:{file.content_type} size:{file.size} path:{file_path} url:{file_url}')
-    else:
-        content = data
+        return await create_file_item(db, background_tasks, current_device, type, saved_file, file.filename,
+                                      content_type)
 
     clipboard_item = schemas.ClipboardItemCreate(
         type=type,
-        data=content,
-        meta=meta
+        data=data,
+        meta={},
+        hash=crud.text_hash(data)
+    )
+    return await save_clipboard_item(db, background_tasks, current_device, clipboard_item)
+
+
+async def create_file_item(db: AsyncSession, background_tasks: BackgroundTasks, device: models.Device,
+                     item_type: str, saved_file: SavedFile, filename: str, content_type: str) -> dict:
+    """为已存入 blob 存储的文件创建剪贴板条目并通知其他设备，条目提交后再删除暂存文件"""
+    file_url = get_file_url(saved_file.path)
+    meta = {
+        "filename": filename,
+        "content_type": content_type,
+        "size": saved_file.size,
+    }
+    log.info(
+        f'Received image or file. file name:{filename} type:{content_type} size:{saved_file.size} path:{saved_file.path} url:{file_url}')
+
+    clipboard_item = schemas.ClipboardItemCreate(
+        type=item_type,
+        data=file_url,
+        meta=meta,
+        hash=saved_file.content_hash
     )
+    file_info = {
+        "url": file_url,  # 文件访问URL
+        "filename": filename,  # 原始文件名
+        "size": saved_file.size,  # 文件大小
+        "content_type": content_type,  # 文件类型
+    }
+    try:
+        return await save_clipboard_item(db, background_tasks, device, clipboard_item, file_info)
+    finally:
+        await blob_store.finish_store(saved_file)
+
+
+async def save_clipboard_item(db: AsyncSession, background_tasks: BackgroundTasks, device: models.Device,
+                        clipboard_item: schemas.ClipboardItemCreate, file_info: dict | None = None) -> dict:
+    """
+    保存剪贴板条目并通知其他设备
+
+    内容与用户最新条目相同时（剪贴板监听重复触发）直接返回已有条目，不写库也不通知
+    """
+    latest = latest_items.match(device.user_id, clipboard_item.type, clipboard_item.hash)
+    if latest:
+        log.info(f'Skip duplicate clipboard item from device:{device.id}, same as item {latest.item_id}')
+        return latest.response
 
     # 创建剪贴板条目
-    db_item = crud.create_clipboard_item(db, clipboard_item, current_device.user_id, current_device.id)
+    db_item = await crud_async.create_clipboard_item(db, clipboard_item, device.user_id, device.id)
+
+    response = {
+        "id": db_item.id,
+        "created_at": db_item.created_at,
+        "hash": db_item.content_hash,
+    }
+    if file_info:
+        response["file_info"] = file_info
+    latest = LatestItem(
+        item_id=db_item.id,
+        item_type=db_item.item_type,
+        content_hash=db_item.content_hash,
+        response=response,
+        expires_at=db_item.expires_at
+    )
+    latest_items.remember(device.user_id, latest)
 
     # 通知其他设备（后台任务）
     background_tasks.add_task(
         notify_devices_of_update,
-        current_user.id,
-        current_device.id,
-        db_item
+        device.user_id,
+        device.id,
+        db_item,
+        latest
     )
+    return response
 
-    if type in ("image", "file"):
-        return {
-            "id": db_item.id,
-            "created_at": db_item.created_at,
-            "hash": db_item.content_hash,
-            "file_info": {
-                "url": file_url,  # 文件访问URL
-                "filename": file.filename,  # 原始文件名
-                "size": file.size,  # 文件大小
-                "content_type": content_type,  # 文件类型
-            }
-        }
+
+# 增量同步
+@app.get("/clipboard/sync")
+async def sync_clipboard_items(
+        last_version: int | None = Query(None, ge=0),
+        limit: int = Query(100, ge=1, le=1000),
+        format: str = Query("full", pattern="^(full|compact)$"),
+        current_device: models.Device = Depends(auth.get_current_device),
+        db: AsyncSession = Depends(get_async_db)
+):
+    """
+    拉取 last_version 之后的条目，按 id 升序分页
+
+    - `last_version`: 客户端已有的最大条目 id，不传时使用服务器记录的该设备同步位置
+    - `limit`: 每页条目数
+    - `format`: full 返回 items 对象列表；compact 返回列式的 columns/devices/rows
+
+    `has_more` 为 true 时以返回的 `last_version` 继续请求
+    """
+    user_id = current_device.user_id
+    if last_version is None:
+        sync_state = await crud_async.get_sync_state(db, user_id, current_device.id)
+        last_version = sync_state.last_synced_id if sync_state else 0
+
+    # 多取一条判断是否还有下一页
+    items = await crud_async.get_clipboard_items_since(db, user_id, last_version, limit + 1)
+    has_more = len(items) > limit
+    items = items[:limit]
+
+    if items:
+        last_version = items[-1].id
+        await crud_async.upsert_sync_state(db, user_id, current_device.id, last_version)
+        await db.commit()
 
     return {
-        "id": db_item.id,
-        "created_at": db_item.created_at,
-        "hash": db_item.content_hash,
+        **build_sync_payload(items, compact=format == "compact"),
+        "last_version": last_version,
+        "latest_version": await crud_async.get_latest_version(db, user_id) if has_more else last_version,
+        "has_more": has_more,
+    }
+
+
+# 历史记录
+@app.get("/clipboard/history")
+async def get_clipboard_history(
+        type: str | None = Query(None, pattern="^(text|image|file)$"),
+        device_id: str | None = None,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        q: str | None = Query(None, max_length=200),
+        before_id: int | None = Query(None, ge=1),
+        limit: int = Query(50, ge=1, le=200),
+        current_user: models.User = Depends(auth.get_current_user),
+        db: AsyncSession = Depends(get_async_db)
+):
+    """
+    按时间倒序查询历史记录
+
+    - `type` / `device_id` / `since` / `until`: 过滤条件
+    - `q`: 全文搜索，多个词用空格分隔，需全部匹配；图片和文件按文件名搜索
+    - `before_id`: 上一页返回的 `next_before_id`，为空时从最新的条目开始
+    """
+    items = await crud_async.get_clipboard_history(
+        db, current_user.id, item_type=type, device_id=device_id, since=since, until=until,
+        search=q.strip() if q else None, before_id=before_id, limit=limit + 1
+    )
+    has_more = len(items) > limit
+    items = items[:limit]
+    return {
+        **build_sync_payload(items),
+        "next_before_id": items[-1].id if has_more else None,
     }
 
 
+def upload_session_response(session) -> dict:
+    return {
+        "upload_id": session.id,
+        "chunk_size": session.chunk_size,
+        "received": session.received,
+        "next_index": session.next_index,
+        "size": session.total_size,
+        "expires_at": session.expires_at,
+    }
+
+
+def get_upload_session_or_404(upload_id: str, device: models.Device):
+    session = upload_sessions.get(upload_id, device.user_id, device.id)
+    if not session:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Upload session not found or expired"
+        )
+    return session
+
+
+# 创建续传上传会话
+@app.post("/clipboard/uploads", response_model=schemas.UploadSessionResponse)
+async def create_upload_session(request: schemas.UploadSessionCreate,
+                                current_device: models.Device = Depends(auth.get_current_active_device)):
+    """
+    创建可续传的分块上传会话
+
+    **上传流程**:
+    1. `POST /clipboard/uploads` 创建会话，得到 `upload_id` 和 `chunk_size`
+    2. `PUT /clipboard/uploads/{upload_id}/chunks/{index}?offset=` 按序上传分块，请求体为原始字节
+    3. 断线后 `GET /clipboard/uploads/{upload_id}` 查询 `received`/`next_index`，从断点继续
+    4. `POST /clipboard/uploads/{upload_id}/complete` 完成上传，创建剪贴板条目并通知其他设备
+    """
+    if request.type not in ("image", "file"):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Only image or file can be uploaded in chunks"
+        )
+    if request.size < 0 or request.size > settings.MAX_UPLOAD_SIZE_MB * 1024 * 1024:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"File size exceeds {settings.MAX_UPLOAD_SIZE_MB}MB limit"
+        )
+    content_type = request.content_type or mimetypes.guess_type(request.filename)[0] or "application/octet-stream"
+    session = upload_sessions.create(current_device.user_id, current_device.id, request.type, request.filename,
+                                     content_type, request.size)
+    return upload_session_response(session)
+
+
+# 查询续传上传进度
+@app.get("/clipboard/uploads/{upload_id}", response_model=schemas.UploadSessionResponse)
+async def get_upload_session(upload_id: str,
+                             current_device: models.Device = Depends(auth.get_current_active_device)):
+    return upload_session_response(get_upload_session_or_404(upload_id, current_device))
+
+
+# 上传分块
+@app.put("/clipboard/uploads/{upload_id}/chunks/{index}", response_model=schemas.UploadSessionResponse)
+async def upload_chunk(upload_id: str,
+                       index: int,
+                       request: Request,
+                       offset: int = Query(..., ge=0),
+                       current_device: models.Device = Depends(auth.get_current_active_device)):
+    session = get_upload_session_or_404(upload_id, current_device)
+
+    # 边接收边检查大小，内存占用不超过一个分块
+    data = bytearray()
+    async for piece in request.stream():
+        data.extend(piece)
+        if len(data) > session.chunk_size:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Chunk exceeds {session.chunk_size} bytes"
+            )
+
+    try:
+        await upload_sessions.append_chunk(session, index, offset, bytes(data))
+    except UploadSessionError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    return upload_session_response(session)
+
+
+# 完成续传上传
+@app.post("/clipboard/uploads/{upload_id}/complete", response_model=schemas.ClipboardItemResponse)
+async def complete_upload_session(upload_id: str,
+                                  background_tasks: BackgroundTasks,
+                                  request: schemas.UploadSessionComplete | None = None,
+                                  current_device: models.Device = Depends(auth.get_current_active_device),
+                                  db: AsyncSession = Depends(get_async_db)):
+    session = get_upload_session_or_404(upload_id, current_device)
+    try:
+        saved_file = await upload_sessions.finalize(session, request.hash if request else None)
+    except UploadSessionError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    log.info(f'Upload session {upload_id} completed. hash: {saved_file.content_hash}')
+    return await create_file_item(db, background_tasks, current_device, session.item_type, saved_file,
+                                  session.filename, session.content_type)
+
+
+# 取消续传上传
+@app.delete("/clipboard/uploads/{upload_id}")
+async def abort_upload_session(upload_id: str,
+                               current_device: models.Device = Depends(auth.get_current_active_device)):
+    session = get_upload_session_or_404(upload_id, current_device)
+    await upload_sessions.abort(session)
+    return {"code": 0, "message": "Upload session aborted"}
+
+
+# 下载剪贴板文件
+@app.api_route("/files/{file_path:path}", methods=["GET", "HEAD"])
+def download_file(file_path: str,
+                  request: Request,
+                  current_user: models.User = Depends(auth.get_current_user),
+                  db: Session = Depends(get_db)):
+    """
+    下载剪贴板中的图片或文件，只能下载属于当前用户的条目
+
+    内容哈希作为强 ETag，支持 `If-None-Match`/`If-Modified-Since` 返回 304，
+    支持 `Range` 断点续传
+    """
+    content_hash = blob_store.parse_blob_path(file_path)
+    item = crud.get_file_item(db, current_user.id, content_hash=content_hash, url=f"/files/{file_path}")
+    if content_hash:
+        path = blob_store.blob_path(content_hash)
+    else:
+        # 旧版按时间戳命名的文件直接位于 uploads 目录下
+        path = os.path.join(UPLOAD_DIR, os.path.basename(file_path))
+    if not item or not os.path.isfile(path):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="File not found"
+        )
+
+    meta = item.meta_data or {}
+    return build_file_response(request, path, item.content_hash or None, meta.get("filename"),
+                               meta.get("content_type"), immutable=content_hash is not None)
+
+
+# 获取文本条目全文
+@app.api_route("/clipboard/{item_id}/content", methods=["GET", "HEAD"])
+async def get_clipboard_content(item_id: int,
+                                request: Request,
+                                current_user: models.User = Depends(auth.get_current_user),
+                                db: AsyncSession = Depends(get_async_db)):
+    """
+    获取文本条目的全文，用于推送消息中只带预览（带 content_url）的大文本
+
+    内容哈希（与推送消息中的 data_hash 相同）作为强 ETag，支持 `If-None-Match` 返回 304
+    """
+    item = await crud_async.get_user_clipboard_item(db, current_user.id, item_id)
+    if not item or item.item_type != "text":
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Item not found"
+        )
+    return build_text_response(request, item.plain_content or "", item.content_hash or None)
+
+
 # WebSocket实时通知，客户端连接，监听消息
 @app.websocket("/sync/notify")
 async def websocket_endpoint(
         websocket: WebSocket,
-        token: str
+        token: str,
+        heartbeat: int | None = None,
+        last_version: int | None = None
 ):
     """
     WebSocket 实时同步通知接口
@@ -496,12 +960,30 @@ async def websocket_endpoint(
     
     **连接参数**:
     - `token`: 访问令牌（access_token），通过查询参数传递
+    - `heartbeat`: 可选，期望的心跳间隔（秒），也可以在 init 消息中通过 heartbeat 字段协商
+    - `last_version`: 可选，客户端已有的最大条目 id，连接后立即补发之后的条目
+    
+    **补发**:
+    客户端通过 `last_version` 参数或 init 消息 `{"action": "init", "version": n}` 请求补发离线期间的条目
+    （init 不带 version 时使用服务器记录的同步位置），服务器按批推送
+    `{"action": "replay", "items": [...], "last_version": n, "has_more": bool, "done": bool}`，
+    补发期间产生的新条目在补发完成后推送，不会重复
+    
+    **编码**:
+    默认为 JSON 文本帧。客户端可以通过子协议（Sec-WebSocket-Protocol）选择二进制帧：
+    `clipboard.msgpack`（MessagePack）或 `clipboard.cbor`（CBOR），客户端发送的消息使用相同编码
+    
+    **心跳**:
+    连接空闲超过心跳间隔时服务器推送 `{"action": "heartbeat"}`，客户端需回复任意消息
+    （如 `{"action": "heartbeat"}`），超时未回复的连接会被服务器以 4408 关闭。
+    连接建立和协商后服务器推送 `{"action": "heartbeat", "interval": 30, "timeout": 15}` 告知实际参数
     
     **消息格式**:
     服务器推送的消息为 JSON 格式：
     ```json
     {
         "action": "update",
+        "id": 1,
         "type": "text|image|file",
         "data": "内容或文件URL",
         "data_hash": "内容哈希值",
@@ -517,10 +999,10 @@ async def websocket_endpoint(
     """
     # 验证token
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        payload = verified_tokens.decode(token)
         user_id: str = payload.get("sub")
         device_id: str = payload.get("device_id")
-        if not user_id or not device_id:
+        if not user_id or not device_id or payload.get("type") == auth.REFRESH_TOKEN_TYPE:
             log.error(f'user:{user_id} or device:{device_id} not found in token')
             # WS_1008_POLICY_VIOLATION: 由于收到不符合约定的数据而断开连接。
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
@@ -531,74 +1013,109 @@ async def websocket_endpoint(
         return
 
     # 检查设备是否存在
-    with get_db_context() as db:
-        device = db.query(models.Device).filter(
-            models.Device.id == device_id,
-            models.Device.user_id == user_id
-        ).first()
+    async with get_async_db_context() as db:
+        device = await crud_async.get_user_device(db, user_id, device_id)
 
-        if not device:
-            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-            return
-
-        crud.activate_device(db, device_id)
+    if not device:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
 
-    # 连接WebSocket
-    await manager.connect(websocket, user_id, device_id)
+    # 连接WebSocket，在线状态由后台批量写回数据库
+    connection = await manager.connect(websocket, user_id, device_id)
+    presence.set_online(device_id)
+    heartbeats.add(connection, heartbeat)
+    replay_task = None
+    if last_version is not None:
+        replay_task = asyncio.create_task(replay_missed_items(connection, last_version))
 
     try:
         while True:
-            data = await websocket.receive_text()
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(received.get("code", 1000), received.get("reason"))
+            data = received.get("text") if received.get("text") is not None else received.get("bytes")
+            # 收到任何消息都说明连接存活，包括心跳回复
+            connection.touch()
             log.debug(f'received message: {data}')
-            # 客户端可以发送心跳或其他控制消息
-            # 在此实现中我们主要处理服务器推送
+            # 客户端消息使用与服务器推送相同的编码
+            message = ws_codec.decode(data, connection.format)
+            if message.get("action") == "init":
+                if "heartbeat" in message:
+                    heartbeats.add(connection, message["heartbeat"])
+                # 每个连接只补发一次
+                if replay_task is None:
+                    version = message.get("version")
+                    replay_task = asyncio.create_task(
+                        replay_missed_items(connection, version if isinstance(version, int) else None))
     except WebSocketDisconnect as e:
         log.warning(f'user: {user_id} device: {device_id} websocket offline. reason: {e}')
     except Exception as e:
         log.error(f'user: {user_id} device: {device_id} websocket except. reason: {e}')
     finally:
-        # 断开时，将数据库里的device的is_active状态置为false
-        with get_db_context() as db:
-            device = db.query(models.Device).filter(
-                models.Device.id == device_id,
-                models.Device.user_id == user_id
-            ).first()
-            if device:
-                device.is_active = False
-                db.commit()
+        if replay_task:
+            replay_task.cancel()
+        await manager.disconnect(connection)
         log.info(f'websocket diconnected.')
-        manager.disconnect(user_id, device_id)
+        # 断开时记录设备离线（同一设备已重新连接时除外）
+        if not manager.is_connected(user_id, device_id):
+            presence.set_offline(device_id)
 
 
 # 通知其他设备有新内容
-async def notify_devices_of_update(user_id: str, source_device_id: str, item: models.ClipboardItem):
-    # 创建新的数据库会话用于后台任务
-    with get_db_context() as db:
-        # 获取当前用户的所有活动设备（除了源设备）
-        devices = db.query(models.Device).filter(
-            models.Device.user_id == user_id,
-            models.Device.id != source_device_id,
-            models.Device.is_active == True
-        ).all()
-
-        if not devices:
-            return
-
-        log.info(f'Notify devices of update. device count: {len(devices)}')
-        # 准备通知消息
-        message = schemas.WebSocketMessage(
-            action="update",
-            type=item.item_type,
-            data=item.content,
-            data_hash=item.content_hash,
-            meta=item.meta_data or {}
-        ).model_dump_json()
-
-        # 向所有相关设备发送通知
-        for device in devices:
-            log.info(f'Notify user:{user_id} from device:{source_device_id} to device:{device.id}')
-            log.debug(f'Send websocket message:{message}')
-            await manager.send_personal_message(message, user_id, device.id)
+async def notify_devices_of_update(user_id: str, source_device_id: str, item: models.ClipboardItem,
+                                   latest: LatestItem | None = None):
+    # 准备通知消息，大文本只带预览，不推送给每个设备
+    fields = content_fields(item)
+    if settings.NOTIFY_DELTA_ENABLED:
+        fields.update(await text_delta.delta_fields(item))
+    message = schemas.WebSocketMessage(
+        action="update",
+        id=item.id,
+        type=item.item_type,
+        data_hash=item.content_hash,
+        meta=item.meta_data or {},
+        **fields
+    ).model_dump_json(exclude_none=True)
+    log.debug(f'Send websocket message:{message}')
+
+    # 合并短时间内的多次通知后发布到消息总线，每个 worker 投递给自己持有的连接
+    await notify_coalescer.submit({
+        "type": "update",
+        "user_id": user_id,
+        "source_device_id": source_device_id,
+        "item_id": item.id,
+        "message": message,
+        "latest": latest.to_dict() if latest else None,
+    })
+
+
+def handle_backplane_event(event: dict):
+    """处理消息总线事件（包括本 worker 发布的），只操作本进程的连接和缓存"""
+    user_id = event["user_id"]
+    if event["type"] == "update":
+        if event.get("latest"):
+            # 其他 worker 处理的上传也要更新本进程的最新条目，避免误判重复
+            latest_items.remember(user_id, LatestItem.from_dict(event["latest"]))
+        # 放入各设备的发送队列，慢设备不影响其他设备
+        # 所有本地连接共享同一消息对象，每种编码只编码一次
+        message = EncodedMessage(json_text=event["message"])
+        sent = manager.broadcast(message, user_id, event["source_device_id"], event.get("item_id"))
+        if sent:
+            log.info(f'Notify user:{user_id} from device:{event["source_device_id"]} to {sent} local devices')
+    elif event["type"] == "forget_latest":
+        latest_items.forget(user_id)
+    elif event["type"] == "revoke_token":
+        verified_tokens.revoke(event["jti"], event["exp"])
+    elif event["type"] == "revoke_families":
+        for family_id in event["families"]:
+            verified_tokens.revoke_family(family_id, event["exp"])
+    elif event["type"] == "invalidate_device":
+        auth_cache.invalidate_device(user_id, event["device_id"])
+        if event.get("disconnect"):
+            # 设备已退出登录或被删除，断开本进程中该设备的连接
+            connection = manager.get_connection(user_id, event["device_id"])
+            if connection:
+                connection.close_soon(1000, "device logged out")
 
 
 # 错误处理
@@ -615,6 +1132,21 @@ async def http_exception_handler(request, exc):
     )
 
 
+@app.exception_handler(PasswordHasherBusy)
+async def password_hasher_busy_handler(request, exc):
+    # 密码哈希线程池已满，快速拒绝，客户端稍后重试
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={
+            "error": {
+                "code": "SERVER_BUSY",
+                "message": "Too many login requests, please retry later"
+            }
+        },
+        headers={"Retry-After": "1"}
+    )
+
+
 # 启动应用
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
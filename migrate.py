@@ -0,0 +1,26 @@
+"""
+一次性创建/升级数据库结构：建表、补齐新增的列和索引、创建历史搜索索引表
+
+单进程部署时服务启动会自动执行（DB_AUTO_UPGRADE）；多 worker 部署时各 worker 会同时执行并互相冲突，
+应关闭 DB_AUTO_UPGRADE，在启动 worker 之前执行一次：
+
+    python migrate.py
+"""
+import log
+import search_index
+from database import create_db
+
+
+def upgrade():
+    create_db()
+    search_index.setup()
+
+
+def main():
+    log.setup_logging()
+    upgrade()
+    log.info('Database schema is up to date')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,13 @@
 """
 生成数据库模型
 """
-from sqlalchemy import Column, Integer, String, Text, Enum, TIMESTAMP, JSON, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Enum, TIMESTAMP, JSON, Boolean, ForeignKey, Index, \
+    LargeBinary
+from sqlalchemy.dialects.mysql import LONGBLOB
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
+import compression
 
 
 class User(Base):
@@ -38,14 +41,34 @@ class ClipboardItem(Base):
     item_type = Column(Enum('text', 'image', 'file'), nullable=False)
     content_hash = Column(String(64), nullable=False)
     content = Column(Text)
+    # 超过阈值的文本压缩后存放在这里，此时 content 为空
+    content_compressed = Column(LargeBinary().with_variant(LONGBLOB, "mysql"))
     meta_data = Column(JSON)
     created_at = Column(TIMESTAMP(6), server_default=func.now(6))
-    expires_at = Column(TIMESTAMP)
+    expires_at = Column(TIMESTAMP, index=True)  # 为空表示永久保留
     is_compressed = Column(Boolean, default=False)
     # version = Column(Integer, nullable=False, index=True)
     user = relationship("User", back_populates="clipboard_items")
     device = relationship("Device")
 
+    @property
+    def plain_content(self) -> str | None:
+        """
+        条目内容，压缩存储的文本在读取时才解压
+
+        按 content_compressed 是否为空判断：旧版本对原样存储的文本也设置了 is_compressed=True
+        """
+        if self.content_compressed is not None:
+            return compression.decompress_text(self.content_compressed)
+        return self.content
+
+    __table_args__ = (
+        # 按哈希校验文件归属
+        Index("ix_clipboard_items_user_id_content_hash", "user_id", "content_hash"),
+        # 增量同步按 (user_id, id) 翻页
+        Index("ix_clipboard_items_user_id_id", "user_id", "id"),
+    )
+
 
 class SyncState(Base):
     __tablename__ = "sync_state"
@@ -55,3 +78,38 @@ class SyncState(Base):
     last_synced_id = Column(Integer, default=0)
     last_sync = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
     device = relationship("Device", back_populates="sync_state")
+
+
+class Blob(Base):
+    """内容寻址存储中的文件，按 content_hash 被 ClipboardItem 引用"""
+    __tablename__ = "blobs"
+    hash = Column(String(64), primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    # 引用该文件的 ClipboardItem 数量，为0时文件可以删除
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+
+
+class RefreshToken(Base):
+    """
+    已签发的刷新令牌，同一次登录后轮换出的令牌属于同一个 family
+    每个刷新令牌只能使用一次，已使用的令牌再次出现说明令牌泄露，整个 family 被吊销
+    """
+    __tablename__ = "refresh_tokens"
+    jti = Column(String(32), primary_key=True)
+    family_id = Column(String(32), nullable=False, index=True)
+    user_id = Column(String(36), nullable=False)
+    device_id = Column(String(64), nullable=False, index=True)
+    expires_at = Column(TIMESTAMP, nullable=False, index=True)
+    used_at = Column(TIMESTAMP)  # 轮换时间，为空表示尚未使用
+    created_at = Column(TIMESTAMP, server_default=func.now())
+
+
+class TokenRevocation(Base):
+    """被吊销的令牌 family，各 worker 按 id 增量同步到内存"""
+    __tablename__ = "token_revocations"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    family_id = Column(String(32), nullable=False)
+    # 该 family 签发的令牌都已过期的时间，之后记录可以删除
+    expires_at = Column(TIMESTAMP, nullable=False, index=True)
+    created_at = Column(TIMESTAMP, server_default=func.now())
@@ -0,0 +1,88 @@
+"""
+按用户合并短时间内的多次更新通知
+连续复制或剪贴板管理器反复写入时，每个条目都会保存，但通知只推送最新的一条：
+窗口外的第一条通知立即发布，之后 NOTIFY_COALESCE_MS 内的通知只保留最新的一条，
+在窗口结束时发布。NOTIFY_COALESCE_MS 为 0 时不合并
+"""
+import asyncio
+from typing import Optional
+
+import log
+from backplane import backplane
+from config import settings
+
+
+class NotifyCoalescer:
+    """stats 记录收到、发布和被合并掉的通知数"""
+
+    def __init__(self, window_ms: int):
+        self._window = window_ms / 1000
+        # user_id -> 窗口内等待发布的最新通知；存在该键表示用户处于合并窗口中
+        self._pending: dict[str, Optional[dict]] = {}
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.stats = {
+            "notifications": 0,
+            "published": 0,
+            "suppressed": 0,
+        }
+
+    async def submit(self, event: dict):
+        self.stats["notifications"] += 1
+        user_id = event["user_id"]
+        if self._window <= 0:
+            await self._publish(event)
+            return
+
+        if user_id not in self._pending:
+            # 窗口外的通知立即发布，不增加延迟
+            self._pending[user_id] = None
+            self._schedule(user_id)
+            await self._publish(event)
+            return
+
+        current = self._pending[user_id]
+        if current is not None:
+            self.stats["suppressed"] += 1
+            if current["item_id"] > event["item_id"]:
+                # 后台任务乱序完成时保留较新的条目
+                return
+        self._pending[user_id] = event
+
+    def _schedule(self, user_id: str):
+        self._timers[user_id] = asyncio.get_running_loop().call_later(self._window, self._on_window_end, user_id)
+
+    def _on_window_end(self, user_id: str):
+        event = self._pending.get(user_id)
+        if event is None:
+            # 窗口内没有新的通知，合并结束
+            self._pending.pop(user_id, None)
+            self._timers.pop(user_id, None)
+            return
+        # 发布最新的通知并开始下一个窗口
+        self._pending[user_id] = None
+        self._schedule(user_id)
+        task = asyncio.create_task(self._publish(event))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _publish(self, event: dict):
+        self.stats["published"] += 1
+        try:
+            await backplane.publish(event)
+        except Exception as e:
+            log.error(f'Publish notification for user:{event["user_id"]} failed: {e}', exc_info=True)
+
+    async def stop(self):
+        """发布所有等待中的通知"""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        pending = [event for event in self._pending.values() if event is not None]
+        self._pending.clear()
+        for event in pending:
+            await self._publish(event)
+
+
+# 全局通知合并实例
+notify_coalescer = NotifyCoalescer(settings.NOTIFY_COALESCE_MS)
@@ -0,0 +1,100 @@
+"""
+bcrypt 密码哈希的专用线程池
+bcrypt 每次计算需要几十到几百毫秒，直接在同步接口中计算会占满 FastAPI 的共享线程池
+（如部署后所有设备同时重新登录），其他同步接口也无法处理。
+密码哈希只在 PASSWORD_HASH_WORKERS 个专用线程中计算，排队的任务超过 PASSWORD_HASH_MAX_QUEUE 时
+直接拒绝（接口返回 503），不让请求无限堆积
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from config import settings
+
+
+class PasswordHasherBusy(Exception):
+    """哈希线程池已满"""
+
+
+def hash_rounds(hashed_password: str) -> int:
+    """bcrypt 哈希中的 cost，格式为 $2b$12$..."""
+    try:
+        return int(hashed_password.split("$")[2])
+    except (IndexError, ValueError):
+        return 0
+
+
+class PasswordHasher:
+    """stats 记录计算次数、登录时重新哈希的次数和因线程池已满被拒绝的次数"""
+
+    def __init__(self, workers: int, max_queue: int, rounds: int):
+        self._workers = workers
+        self._max_pending = workers + max_queue
+        self._rounds = rounds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        # 只在事件循环线程中修改，不需要加锁
+        self._pending = 0
+        self.stats = {
+            "hashed": 0,
+            "verified": 0,
+            "rehashed": 0,
+            "rejected": 0,
+        }
+
+    def _hash_sync(self, password: str) -> str:
+        return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(self._rounds)).decode("utf-8")
+
+    @staticmethod
+    def _verify_sync(password: str, hashed_password: str) -> bool:
+        return bcrypt.checkpw(password.encode("utf-8"), hashed_password.encode("utf-8"))
+
+    async def _run(self, fn, *args):
+        if self._pending >= self._max_pending:
+            self.stats["rejected"] += 1
+            raise PasswordHasherBusy()
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        hashed_password = await self._run(self._hash_sync, password)
+        self.stats["hashed"] += 1
+        return hashed_password
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        result = await self._run(self._verify_sync, password, hashed_password)
+        self.stats["verified"] += 1
+        return result
+
+    def needs_rehash(self, hashed_password: str) -> bool:
+        """哈希的 cost 与当前 BCRYPT_ROUNDS 不同（调整配置后登录时重新哈希）"""
+        return hash_rounds(hashed_password) != self._rounds
+
+    async def rehash_if_needed(self, password: str, hashed_password: str) -> str | None:
+        """
+        密码验证通过后调用，需要重新哈希时返回新的哈希
+
+        线程池繁忙时跳过，下次登录再重新哈希
+        """
+        if not self.needs_rehash(hashed_password):
+            return None
+        try:
+            new_hash = await self.hash(password)
+        except PasswordHasherBusy:
+            return None
+        self.stats["rehashed"] += 1
+        return new_hash
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "pending": self._pending, "workers": self._workers}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# 全局密码哈希实例
+password_hasher = PasswordHasher(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_MAX_QUEUE,
+                                 settings.BCRYPT_ROUNDS)
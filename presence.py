@@ -0,0 +1,152 @@
+"""
+设备在线状态
+ConnectionManager 是设备是否在线的实时来源，Device.is_active / last_active 只是定期批量写回的快照：
+连接和断开时只记录变化，由后台任务合并后写入数据库，同时刷新本 worker 在线设备的 last_active。
+worker 异常退出后其设备的 last_active 不再刷新，超过 PRESENCE_STALE_SECONDS 即视为离线。
+REST 请求的最后活动时间同样只记录在内存中，每个设备只保留最新的时间，随在线状态一起批量写入
+"""
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import crud_async
+import log
+import models
+from auth_cache import auth_cache
+from config import settings
+from connection_manager import manager
+from database import get_async_db_context
+
+# 单条 UPDATE ... WHERE id IN (...) 的最大设备数
+FLUSH_BATCH_SIZE = 500
+
+
+class PresenceTracker:
+    """设备在线状态的写回缓存，stats 记录写回指标"""
+
+    def __init__(self):
+        # device_id -> 待写入的 is_active
+        self._pending: dict[str, bool] = {}
+        # device_id -> 待写入的 last_active（REST 请求）
+        self._last_active: dict[str, datetime] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "flushes": 0,
+            "touches": 0,
+            "rows_written": 0,
+            "last_flush_ms": 0.0,
+            "flush_failures": 0,
+        }
+
+    def set_online(self, device_id: str):
+        self._pending[device_id] = True
+
+    def set_offline(self, device_id: str):
+        self._pending[device_id] = False
+
+    def touch(self, device_id: str):
+        """记录设备的 REST 请求，代替每个请求写一次数据库"""
+        self._last_active[device_id] = datetime.now(timezone.utc)
+        self.stats["touches"] += 1
+
+    def last_active(self, device: models.Device) -> Optional[datetime]:
+        """数据库中的 last_active 与本 worker 尚未写入的时间中较新的一个"""
+        last_active = device.last_active
+        if last_active is not None and last_active.tzinfo is None:
+            last_active = last_active.replace(tzinfo=timezone.utc)
+        pending = self._last_active.get(device.id)
+        if pending and (last_active is None or pending > last_active):
+            return pending
+        return last_active
+
+    def is_active(self, device: models.Device) -> bool:
+        """
+        设备是否处于激活状态（REST 接口据此鉴权）
+
+        本 worker 持有的连接和尚未写入的变化比数据库快照新，优先使用
+        """
+        if manager.is_connected(device.user_id, device.id):
+            return True
+        pending = self._pending.get(device.id)
+        if pending is not None:
+            return pending
+        return bool(device.is_active)
+
+    def is_online(self, device: models.Device) -> bool:
+        """本 worker 持有连接或尚未写入上线，或数据库快照在有效期内标记为在线"""
+        if manager.is_connected(device.user_id, device.id):
+            return True
+        pending = self._pending.get(device.id)
+        if pending is not None:
+            # 本 worker 尚未写入的变化比数据库快照新
+            return pending
+        last_active = self.last_active(device)
+        if not device.is_active or last_active is None:
+            return False
+        return last_active >= datetime.now(timezone.utc) - timedelta(seconds=settings.PRESENCE_STALE_SECONDS)
+
+    async def flush(self, shutting_down: bool = False):
+        """
+        写入积累的状态变化，刷新本 worker 所有在线设备的 last_active，并写入 REST 请求的最后活动时间
+
+        Args:
+            shutting_down: 进程即将退出，本 worker 的连接全部写为离线
+        """
+        pending, self._pending = self._pending, {}
+        touched, self._last_active = self._last_active, {}
+        online = {device_id for devices in manager.active_connections.values() for device_id in devices}
+        if shutting_down:
+            pending.update((device_id, False) for device_id in online)
+            online = set()
+        # 断开后又重新连上的设备以当前连接为准
+        offline = [device_id for device_id, is_active in pending.items() if not is_active and device_id not in online]
+        online.update(device_id for device_id, is_active in pending.items() if is_active)
+        # 写入在线状态的设备 last_active 同时更新为当前时间
+        touched_ids = sorted(set(touched) - online - set(offline))
+        if not online and not offline and not touched_ids:
+            return
+
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        try:
+            async with get_async_db_context() as db:
+                for is_active, device_ids in ((True, sorted(online)), (False, offline)):
+                    for i in range(0, len(device_ids), FLUSH_BATCH_SIZE):
+                        await crud_async.set_devices_active(db, device_ids[i:i + FLUSH_BATCH_SIZE], is_active, now)
+                for i in range(0, len(touched_ids), FLUSH_BATCH_SIZE):
+                    await crud_async.set_devices_last_active(
+                        db, {device_id: touched[device_id] for device_id in touched_ids[i:i + FLUSH_BATCH_SIZE]})
+                await db.commit()
+        except Exception as e:
+            # 保留未写入的变化，下次重试（期间产生的新变化优先）
+            self._pending = {**pending, **self._pending}
+            self._last_active = {**touched, **self._last_active}
+            self.stats["flush_failures"] += 1
+            log.error(f'Flush device presence failed: {e}')
+            return
+
+        # 缓存的设备中 is_active 已过期
+        if pending:
+            auth_cache.invalidate_devices(set(pending))
+        self.stats["flushes"] += 1
+        self.stats["rows_written"] += len(online) + len(offline) + len(touched_ids)
+        self.stats["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_FLUSH_INTERVAL_SECONDS)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush(shutting_down=True)
+
+
+# 全局设备在线状态实例
+presence = PresenceTracker()
@@ -0,0 +1,73 @@
+"""
+WebSocket 连接后补发离线期间的条目
+客户端在 init 消息的 version（或查询参数 last_version）中给出已有的最大条目 id，
+没有给出时使用服务器记录的同步位置。补发期间的实时消息暂存在连接上，补发完成后只发送补发范围之后的条目，
+之后迟到的实时消息同样按补发到的条目 id 去重，保证不丢失也不重复。大文本与实时推送一样只带预览
+"""
+import json
+from typing import Optional
+
+import crud_async
+import log
+from config import settings
+from connection_manager import Connection
+from database import get_async_db_context
+from sync_payload import sync_item
+
+
+async def replay_missed_items(connection: Connection, last_version: Optional[int] = None):
+    """
+    按批次补发 last_version 之后其他设备上传的条目
+
+    每批一个消息 {"action": "replay", "items": [...], "last_version": n, "has_more": bool, "done": bool}，
+    done 为 true 的消息之后进入实时推送。超过 WS_REPLAY_MAX_ITEMS 条时提前结束补发，
+    此时最后一批的 has_more 仍为 true，客户端应改用 /clipboard/sync 从 last_version 继续同步
+    """
+    skip_ids = connection.begin_replay()
+    # 已处理完的批次覆盖到的条目id
+    replayed_through = 0
+    sent = 0
+    try:
+        if last_version is None:
+            async with get_async_db_context() as db:
+                sync_state = await crud_async.get_sync_state(db, connection.user_id, connection.device_id)
+            last_version = sync_state.last_synced_id if sync_state else 0
+        cursor = last_version
+
+        while True:
+            # 每批使用独立的会话，等待慢连接时不占用数据库连接
+            batch_size = settings.WS_REPLAY_BATCH_SIZE
+            async with get_async_db_context() as db:
+                items = await crud_async.get_clipboard_items_since(db, connection.user_id, cursor, batch_size + 1)
+            has_more = len(items) > batch_size
+            items = items[:batch_size]
+            if items:
+                cursor = items[-1].id
+            # 本设备上传的条目和已经实时推送过的条目不需要补发
+            payload = [sync_item(item, preview_large=True) for item in items
+                       if item.device_id != connection.device_id and item.id not in skip_ids]
+            sent += len(payload)
+            done = not has_more or sent >= settings.WS_REPLAY_MAX_ITEMS
+            if payload or done:
+                message = json.dumps({
+                    "action": "replay",
+                    "items": payload,
+                    "last_version": cursor,
+                    "has_more": has_more,
+                    "done": done,
+                })
+                if not await connection.send_replay(message):
+                    return
+            replayed_through = cursor
+            if done:
+                break
+
+        if cursor > last_version:
+            async with get_async_db_context() as db:
+                await crud_async.upsert_sync_state(db, connection.user_id, connection.device_id, cursor)
+                await db.commit()
+        log.info(f'Replayed {sent} items to user:{connection.user_id} device:{connection.device_id}')
+    except Exception as e:
+        log.error(f'Replay to user:{connection.user_id} device:{connection.device_id} failed: {e}', exc_info=True)
+    finally:
+        connection.end_replay(replayed_through)
@@ -0,0 +1,226 @@
+"""
+剪贴板条目保留策略
+后台定期删除过期（expires_at）和超出每用户保留条数的条目，每批在独立的短事务中删除，
+避免长时间锁表；同时清理不再被引用的上传文件
+"""
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import func
+from starlette.concurrency import run_in_threadpool
+
+import blob_store
+import crud
+import log
+import models
+from config import settings
+from database import get_db_context
+from file_storage import UPLOAD_DIR
+
+# 批次之间让出数据库给其他写入
+BATCH_PAUSE_SECONDS = 0.05
+
+
+class RetentionSweeper:
+    """过期条目清理任务，stats 记录清理指标"""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._last_orphan_scan = 0.0
+        self.stats = {
+            "sweeps": 0,
+            "rows_deleted": 0,
+            "bytes_reclaimed": 0,
+            "files_removed": 0,
+            "batches": 0,
+            "last_batch_latency_ms": 0.0,
+            "max_batch_latency_ms": 0.0,
+            "last_sweep_duration_ms": 0.0,
+            "last_sweep_at": None,
+        }
+
+    def _delete_batch(self, query_ids) -> int:
+        """
+        删除一批条目并提交
+
+        Args:
+            query_ids: 接收 db、返回待删除条目 id 列表的函数
+
+        Returns:
+            删除的行数
+        """
+        started = time.perf_counter()
+        with get_db_context() as db:
+            item_ids = query_ids(db)
+            if not item_ids:
+                return 0
+            reclaimed = db.query(
+                func.coalesce(func.sum(func.length(models.ClipboardItem.content)), 0) +
+                func.coalesce(func.sum(func.length(models.ClipboardItem.content_compressed)), 0)
+            ).filter(models.ClipboardItem.id.in_(item_ids)).scalar() or 0
+            file_hashes = crud.delete_clipboard_items(db, item_ids)
+            db.commit()
+            removed = crud.delete_unreferenced_blobs(db, list(set(file_hashes)))
+            if removed:
+                reclaimed += sum(self._blob_sizes(removed))
+                blob_store.remove_blob_files(db, removed)
+                self.stats["files_removed"] += len(removed)
+
+        latency = (time.perf_counter() - started) * 1000
+        self.stats["rows_deleted"] += len(item_ids)
+        self.stats["bytes_reclaimed"] += int(reclaimed)
+        self.stats["batches"] += 1
+        self.stats["last_batch_latency_ms"] = round(latency, 2)
+        self.stats["max_batch_latency_ms"] = max(self.stats["max_batch_latency_ms"], round(latency, 2))
+        time.sleep(BATCH_PAUSE_SECONDS)
+        return len(item_ids)
+
+    @staticmethod
+    def _blob_sizes(content_hashes: list[str]):
+        for content_hash in content_hashes:
+            try:
+                yield os.path.getsize(blob_store.blob_path(content_hash))
+            except OSError:
+                pass
+
+    def _sweep_expired(self) -> int:
+        now = datetime.now(timezone.utc)
+        batch_size = settings.RETENTION_SWEEP_BATCH_SIZE
+
+        def expired_ids(db):
+            # 走 expires_at 索引，每次只取一批
+            return [row.id for row in db.query(models.ClipboardItem.id).filter(
+                models.ClipboardItem.expires_at <= now
+            ).order_by(models.ClipboardItem.expires_at).limit(batch_size).all()]
+
+        deleted = 0
+        while True:
+            count = self._delete_batch(expired_ids)
+            deleted += count
+            if count < batch_size:
+                return deleted
+
+    def _sweep_over_limit(self) -> int:
+        keep_last = settings.RETENTION_KEEP_LAST_N
+        if keep_last <= 0:
+            return 0
+        batch_size = settings.RETENTION_SWEEP_BATCH_SIZE
+
+        with get_db_context() as db:
+            user_ids = [row.user_id for row in db.query(models.ClipboardItem.user_id).group_by(
+                models.ClipboardItem.user_id
+            ).having(func.count(models.ClipboardItem.id) > keep_last).all()]
+
+        deleted = 0
+        for user_id in user_ids:
+            with get_db_context() as db:
+                # 第 N 条之后（更旧）的条目都超出了保留数量
+                cutoff = db.query(models.ClipboardItem.id).filter(
+                    models.ClipboardItem.user_id == user_id
+                ).order_by(models.ClipboardItem.id.desc()).offset(keep_last).limit(1).scalar()
+            if cutoff is None:
+                continue
+
+            def over_limit_ids(db):
+                return [row.id for row in db.query(models.ClipboardItem.id).filter(
+                    models.ClipboardItem.user_id == user_id,
+                    models.ClipboardItem.id <= cutoff
+                ).order_by(models.ClipboardItem.id).limit(batch_size).all()]
+
+            while True:
+                count = self._delete_batch(over_limit_ids)
+                deleted += count
+                if count < batch_size:
+                    break
+        return deleted
+
+    def _remove_orphan_files(self) -> int:
+        """删除没有被任何条目引用、且超过保留时间的上传文件"""
+        grace_seconds = settings.RETENTION_ORPHAN_SCAN_HOURS * 3600
+        if time.time() - self._last_orphan_scan < grace_seconds:
+            return 0
+        self._last_orphan_scan = time.time()
+        deadline = time.time() - grace_seconds
+
+        removed = 0
+        with get_db_context() as db:
+            # 引用计数为0的 blob
+            unreferenced = crud.delete_unreferenced_blobs(db)
+            blob_store.remove_blob_files(db, unreferenced)
+            removed += len(unreferenced)
+
+            # 没有 blobs 记录的 blob 文件（例如写入后请求被取消）
+            for root, _, files in os.walk(blob_store.BLOB_DIR):
+                for name in files:
+                    path = os.path.join(root, name)
+                    if os.path.getmtime(path) >= deadline:
+                        continue
+                    if blob_store.parse_blob_path(os.path.relpath(path, UPLOAD_DIR).replace(os.sep, "/")):
+                        # 与上传并发时可能正被重新引用，按无引用 blob 的方式删除
+                        if db.get(models.Blob, name) is None:
+                            blob_store.remove_blob_files(db, [name])
+                            removed += 1
+                    else:
+                        # 写入中断的临时文件
+                        os.remove(path)
+                        removed += 1
+
+            # 旧版按时间戳命名、直接位于 uploads 下的文件
+            if os.path.isdir(UPLOAD_DIR):
+                candidates = [name for name in os.listdir(UPLOAD_DIR)
+                              if os.path.isfile(os.path.join(UPLOAD_DIR, name))
+                              and os.path.getmtime(os.path.join(UPLOAD_DIR, name)) < deadline]
+                if candidates:
+                    # content 没有索引，每次扫描只查询一次仍被引用的旧版文件
+                    referenced = {row.content for row in db.query(models.ClipboardItem.content).filter(
+                        models.ClipboardItem.item_type.in_(('image', 'file')),
+                        models.ClipboardItem.content.like("/files/%"),
+                        models.ClipboardItem.content.notlike("/files/blobs/%")
+                    ).distinct()}
+                    for name in candidates:
+                        if f"/files/{name}" not in referenced:
+                            os.remove(os.path.join(UPLOAD_DIR, name))
+                            removed += 1
+
+        if removed:
+            log.info(f'Removed {removed} orphaned upload files')
+        self.stats["files_removed"] += removed
+        return removed
+
+    def sweep(self) -> dict:
+        """执行一次完整清理，返回本次清理结果"""
+        started = time.perf_counter()
+        expired = self._sweep_expired()
+        over_limit = self._sweep_over_limit()
+        orphans = self._remove_orphan_files()
+
+        self.stats["sweeps"] += 1
+        self.stats["last_sweep_duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        self.stats["last_sweep_at"] = datetime.now(timezone.utc).isoformat()
+        if expired or over_limit or orphans:
+            log.info(f'Retention sweep done. expired: {expired} over limit: {over_limit} orphan files: {orphans}')
+        return {"expired": expired, "over_limit": over_limit, "orphan_files": orphans}
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(settings.RETENTION_SWEEP_INTERVAL_SECONDS)
+            try:
+                await run_in_threadpool(self.sweep)
+            except Exception as e:
+                log.error(f'Retention sweep failed: {e}', exc_info=True)
+
+    def start(self):
+        self._last_orphan_scan = time.time()
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+# 全局保留策略清理实例
+retention_sweeper = RetentionSweeper()
@@ -1,6 +1,6 @@
 from datetime import datetime
 from pydantic import BaseModel, EmailStr
-from typing import Optional
+from typing import Optional, Union
 
 
 class UserCreate(BaseModel):
@@ -49,6 +49,7 @@ class ClipboardItemCreate(BaseModel):
     type: str
     data: str  # 对于图片，是URL
     meta: Optional[dict] = None
+    hash: Optional[str] = None  # 文件内容的sha256，上传时计算
 
 
 class FileInfo(BaseModel):
@@ -65,9 +66,34 @@ class ClipboardItemResponse(BaseModel):
     file_info: Optional[FileInfo] = None
 
 
+class UploadSessionCreate(BaseModel):
+    type: str  # image 或 file
+    filename: str
+    size: int
+    content_type: Optional[str] = None
+
+
+class UploadSessionComplete(BaseModel):
+    hash: Optional[str] = None  # 客户端计算的sha256，提供时会校验
+
+
+class UploadSessionResponse(BaseModel):
+    upload_id: str
+    chunk_size: int
+    received: int  # 已接收字节数，即下一个分块的偏移量
+    next_index: int  # 下一个分块序号
+    size: int
+    expires_at: datetime
+
+
 class WebSocketMessage(BaseModel):
     action: str
+    id: Optional[int] = None  # 条目id（同步版本号）
     type: str
-    data: str  # 对于图片，是URL
+    data: str  # 对于图片，是URL；带 content_url 时只是文本的预览
     data_hash: str
     meta: Optional[dict] = None
+    size: Optional[int] = None  # 只带预览时全文的字节数
+    content_url: Optional[str] = None  # 只带预览时获取全文的地址
+    delta: Optional[list[Union[int, str]]] = None  # 相对 base_hash 对应文本的差异，见 text_delta
+    base_hash: Optional[str] = None
@@ -0,0 +1,193 @@
+"""
+剪贴板历史的全文索引
+文本可能压缩存储，无法直接在 clipboard_items 上建全文索引，因此单独维护一张索引表，
+与条目在同一事务中写入和删除：
+    SQLite: FTS5 虚拟表（trigram 分词，支持中文子串搜索），rowid 为条目 id
+    MySQL:  clipboard_search 表 + ngram 解析器的 FULLTEXT 索引
+    其他:   clipboard_search 表，使用 LIKE 查询
+
+已有数据库升级后运行 python search_index.py 为历史条目建立索引
+"""
+import argparse
+import sqlite3
+import time
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import log
+import models
+from config import settings
+from database import engine, get_db_context
+
+SEARCH_TABLE = "clipboard_search"
+DIALECT = engine.dialect.name
+# 索引表中条目 id 的列名
+ID_COLUMN = "rowid" if DIALECT == "sqlite" else "item_id"
+# SQLite 3.34 之前没有 trigram 分词器，只能按词匹配
+FTS5_TOKENIZER = "trigram" if sqlite3.sqlite_version_info >= (3, 34, 0) else "unicode61"
+# trigram 分词只能匹配至少3个字符的词
+TRIGRAM_MIN_CHARS = 3
+
+
+def setup():
+    """创建索引表（已存在时跳过）"""
+    with engine.begin() as conn:
+        if DIALECT == "sqlite":
+            conn.execute(text(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+                f"USING fts5(user_key, content, tokenize='{FTS5_TOKENIZER}')"
+            ))
+        elif DIALECT == "mysql":
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ("
+                "item_id INT PRIMARY KEY, "
+                "user_id VARCHAR(36) NOT NULL, "
+                "content LONGTEXT, "
+                "KEY ix_clipboard_search_user_id (user_id), "
+                "FULLTEXT KEY ft_clipboard_search_content (content) WITH PARSER ngram"
+                ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"
+            ))
+        else:
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ("
+                "item_id INTEGER PRIMARY KEY, user_id VARCHAR(36) NOT NULL, content TEXT)"
+            ))
+
+
+def searchable_text(item_type: str, data: str | None, meta: dict | None) -> str:
+    """文本条目索引内容本身，图片/文件索引文件名"""
+    if item_type == "text":
+        return (data or "")[:settings.SEARCH_INDEX_MAX_CHARS]
+    return (meta or {}).get("filename") or ""
+
+
+def _user_key(user_id: str) -> str:
+    # FTS5 中按用户过滤的列，去掉连字符作为一个完整的词
+    return "u" + user_id.replace("-", "")
+
+
+def _index_row(item: models.ClipboardItem, content: str) -> dict:
+    return {"id": item.id, "user_id": item.user_id, "user_key": _user_key(item.user_id), "content": content}
+
+
+def _insert_statement():
+    if DIALECT == "sqlite":
+        return text(f"INSERT INTO {SEARCH_TABLE} (rowid, user_key, content) VALUES (:id, :user_key, :content)")
+    return text(f"INSERT INTO {SEARCH_TABLE} (item_id, user_id, content) VALUES (:id, :user_id, :content)")
+
+
+async def index_item(db: AsyncSession, item: models.ClipboardItem, data: str | None):
+    """索引新条目（不提交，与条目在同一事务中写入）"""
+    content = searchable_text(item.item_type, data, item.meta_data)
+    if content:
+        await db.execute(_insert_statement(), _index_row(item, content))
+
+
+def remove_items(db: Session, item_ids: list[int]):
+    """删除条目的索引（不提交）"""
+    if not item_ids:
+        return
+    db.execute(text(f"DELETE FROM {SEARCH_TABLE} WHERE {ID_COLUMN} IN :ids").bindparams(
+        bindparam("ids", expanding=True)), {"ids": item_ids})
+
+
+def remove_device_items(db: Session, device_id: str):
+    """删除设备所有条目的索引（不提交），需在删除条目之前调用"""
+    db.execute(text(
+        f"DELETE FROM {SEARCH_TABLE} WHERE {ID_COLUMN} IN "
+        "(SELECT id FROM clipboard_items WHERE device_id = :device_id)"
+    ), {"device_id": device_id})
+
+
+def _quote(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+def match_clause(user_id: str, query: str):
+    """
+    返回匹配用户 query 的条目 id 子查询，用于 ClipboardItem.id.in_(...)
+
+    空白分隔的多个词之间为 AND 关系，词本身按字面匹配（不支持搜索语法）
+    """
+    terms = query.split()
+    if DIALECT == "sqlite":
+        key = _user_key(user_id)
+        if FTS5_TOKENIZER == "trigram" and any(len(term) < TRIGRAM_MIN_CHARS for term in terms):
+            # 短词无法使用 trigram 索引，在该用户的索引行中逐行 LIKE
+            conditions = " AND ".join(f"content LIKE :term{i} ESCAPE '\\'" for i in range(len(terms)))
+            return text(
+                f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :user_match AND {conditions}"
+            ).bindparams(user_match=f"user_key:{_quote(key)}",
+                         **{f"term{i}": f"%{_escape_like(term)}%" for i, term in enumerate(terms)})
+        expression = " AND ".join([f"user_key:{_quote(key)}"] + [f"content:{_quote(term)}" for term in terms])
+        return text(f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :expression").bindparams(
+            expression=expression)
+
+    if DIALECT == "mysql":
+        # 布尔模式下每个词都必须出现，ngram 解析器按字面短语匹配。
+        # 短语中的双引号无法转义，去掉后用于全文匹配，含双引号的词再逐行 LIKE 保证按字面匹配
+        phrases = [term.replace('"', "") for term in terms if term.replace('"', "")]
+        conditions = ["MATCH(content) AGAINST (:expression IN BOOLEAN MODE)"] if phrases else []
+        # MySQL 字符串字面量中反斜杠本身需要转义
+        conditions += [f"content LIKE :term{i} ESCAPE '\\\\'" for i, term in enumerate(terms) if '"' in term]
+        params = {f"term{i}": f"%{_escape_like(term)}%" for i, term in enumerate(terms) if '"' in term}
+        if phrases:
+            params["expression"] = " ".join(f'+"{phrase}"' for phrase in phrases)
+        return text(
+            f"SELECT item_id FROM {SEARCH_TABLE} WHERE user_id = :user_id AND " + " AND ".join(conditions)
+        ).bindparams(user_id=user_id, **params)
+
+    conditions = " AND ".join(f"content LIKE :term{i} ESCAPE '\\'" for i in range(len(terms)))
+    return text(f"SELECT item_id FROM {SEARCH_TABLE} WHERE user_id = :user_id AND {conditions}").bindparams(
+        user_id=user_id, **{f"term{i}": f"%{_escape_like(term)}%" for i, term in enumerate(terms)})
+
+
+def _escape_like(term: str) -> str:
+    # 先转义转义符本身，否则词中的反斜杠会吞掉后面的字符
+    return term.replace("\\", "\\\\").replace("%", r"\%").replace("_", r"\_")
+
+
+def backfill(batch_size: int, pause: float):
+    """按批重建所有条目的索引"""
+    last_id = 0
+    total = 0
+    while True:
+        with get_db_context() as db:
+            items = db.query(models.ClipboardItem).filter(
+                models.ClipboardItem.id > last_id
+            ).order_by(models.ClipboardItem.id).limit(batch_size).all()
+            if not items:
+                break
+            last_id = items[-1].id
+            item_ids = [item.id for item in items]
+            remove_items(db, item_ids)
+            rows = []
+            for item in items:
+                content = searchable_text(item.item_type, item.plain_content, item.meta_data)
+                if content:
+                    rows.append(_index_row(item, content))
+            if rows:
+                db.execute(_insert_statement(), rows)
+            db.commit()
+            total += len(rows)
+        log.info(f'Indexed {total} items, last id {last_id}')
+        time.sleep(pause)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the clipboard history search index")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--pause", type=float, default=0.05, help="seconds to sleep between batches")
+    args = parser.parse_args()
+
+    log.setup_logging()
+    setup()
+    total = backfill(args.batch_size, args.pause)
+    log.info(f'Search index backfill done. indexed: {total}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+增量同步返回的条目格式
+full: 每个条目一个对象，字段与 WebSocket 推送一致
+compact: 列式格式，字段名只出现一次，来源设备 id 按下标引用 devices 列表，
+         适合离线设备一次拉取大量条目
+WebSocket 推送（实时和补发）中的大文本只带预览，见 content_fields
+"""
+import models
+from config import settings
+
+COMPACT_COLUMNS = ["version", "type", "data", "data_hash", "source_device", "meta", "created_at"]
+
+
+def content_url(item_id: int) -> str:
+    return f"/clipboard/{item_id}/content"
+
+
+def content_fields(item: models.ClipboardItem) -> dict:
+    """
+    推送消息中的内容字段
+
+    文本超过 NOTIFY_INLINE_MAX_BYTES 时 data 只是前 NOTIFY_PREVIEW_CHARS 个字符的预览，
+    另带全文字节数 size 和获取地址 content_url，客户端需要时再获取全文并用 data_hash 校验
+    """
+    data = item.plain_content
+    limit = settings.NOTIFY_INLINE_MAX_BYTES
+    # UTF-8 每个字符最多4字节，字符数不超过 limit/4 时不需要编码计算大小
+    if item.item_type != "text" or not data or not limit or len(data) <= limit // 4:
+        return {"data": data}
+    size = len(data.encode("utf-8"))
+    if size <= limit:
+        return {"data": data}
+    return {"data": data[:settings.NOTIFY_PREVIEW_CHARS], "size": size, "content_url": content_url(item.id)}
+
+
+def sync_item(item: models.ClipboardItem, preview_large: bool = False) -> dict:
+    """preview_large 为 True 时大文本只带预览（用于 WebSocket 推送）"""
+    fields = content_fields(item) if preview_large else {"data": item.plain_content}
+    return {
+        "id": item.id,
+        "version": item.id,
+        "type": item.item_type,
+        **fields,
+        "data_hash": item.content_hash,
+        "source_device": item.device_id,
+        "meta": item.meta_data or {},
+        "created_at": item.created_at.isoformat() if item.created_at else None,
+    }
+
+
+def build_sync_payload(items: list[models.ClipboardItem], compact: bool = False) -> dict:
+    if not compact:
+        return {"items": [sync_item(item) for item in items]}
+
+    devices: dict[str, int] = {}
+    rows = []
+    for item in items:
+        rows.append([
+            item.id,
+            item.item_type,
+            item.plain_content,
+            item.content_hash,
+            devices.setdefault(item.device_id, len(devices)),
+            item.meta_data or {},
+            item.created_at.isoformat() if item.created_at else None,
+        ])
+    return {"columns": COMPACT_COLUMNS, "devices": list(devices), "rows": rows}
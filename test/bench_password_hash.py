@@ -0,0 +1,69 @@
+"""
+密码哈希基准测试
+
+测量不同 bcrypt cost 下单核每秒可以验证的登录次数，
+以及专用线程池在不同线程数下的吞吐量（bcrypt 计算时释放 GIL，线程数不超过 CPU 核数时接近线性增长）
+
+用法（在项目根目录执行）：python test/bench_password_hash.py [--rounds 10 11 12] [--logins 64]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bcrypt  # noqa: E402
+
+from password_hasher import PasswordHasher  # noqa: E402
+
+PASSWORD = "correct horse battery staple"
+
+
+def bench_single_core(rounds: int, number: int) -> float:
+    """单线程每秒验证次数"""
+    hashed = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(rounds))
+    start = time.perf_counter()
+    for _ in range(number):
+        bcrypt.checkpw(PASSWORD.encode(), hashed)
+    return number / (time.perf_counter() - start)
+
+
+async def bench_pool(rounds: int, workers: int, logins: int) -> float:
+    """logins 个并发登录通过线程池验证，返回每秒验证次数"""
+    hasher = PasswordHasher(workers, logins, rounds)
+    hashed = await hasher.hash(PASSWORD)
+    start = time.perf_counter()
+    await asyncio.gather(*(hasher.verify(PASSWORD, hashed) for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+    hasher.shutdown()
+    return logins / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bcrypt login throughput benchmark")
+    parser.add_argument("--rounds", type=int, nargs="+", default=[10, 11, 12])
+    parser.add_argument("--logins", type=int, default=64, help="concurrent logins for the pool benchmark")
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    print(f"cpu cores: {cores}")
+    print(f"\n{'rounds':<8}{'ms/login':>10}{'logins/s/core':>16}")
+    for rounds in args.rounds:
+        number = max(4, 2 ** (14 - rounds))
+        rate = bench_single_core(rounds, number)
+        print(f"{rounds:<8}{1000 / rate:>10.1f}{rate:>16.1f}")
+
+    rounds = args.rounds[-1]
+    print(f"\npool throughput, rounds={rounds}, {args.logins} concurrent logins")
+    print(f"{'workers':<8}{'logins/s':>10}")
+    workers = 1
+    while workers <= cores:
+        rate = asyncio.run(bench_pool(rounds, workers, args.logins))
+        print(f"{workers:<8}{rate:>10.1f}")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+WebSocket 消息编码基准测试
+
+比较 JSON / MessagePack / CBOR 对典型通知（短文本、长文本、图片、文件）的编码耗时和帧大小，
+以及广播给多个设备时每条消息只编码一次与每个连接各自编码的差别
+
+用法（在项目根目录执行，需要安装 msgpack 和 cbor2）：python test/bench_ws_codec.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ws_codec  # noqa: E402
+from schemas import WebSocketMessage  # noqa: E402
+from ws_codec import EncodedMessage  # noqa: E402
+
+BLOB_HASH = "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+
+MESSAGES = {
+    "short text": WebSocketMessage(
+        action="update", id=123456, type="text", data="https://example.com/some/page?ref=clipboard",
+        data_hash="5d41402abc4b2a76b9719d911017c592", meta={}),
+    "long text": WebSocketMessage(
+        action="update", id=123457, type="text", data="剪贴板同步 clipboard sync. " * 400,
+        data_hash="7d793037a0760186574b0282f2f435e7", meta={}),
+    "image": WebSocketMessage(
+        action="update", id=123458, type="image", data=f"/files/blobs/e3/b0/{BLOB_HASH}",
+        data_hash=BLOB_HASH, meta={"filename": "Screenshot 2024-05-01 at 10.21.33.png",
+                                   "content_type": "image/png", "size": 482113}),
+    "file": WebSocketMessage(
+        action="update", id=123459, type="file", data=f"/files/blobs/e3/b0/{BLOB_HASH}",
+        data_hash=BLOB_HASH, meta={"filename": "quarterly-report-final-v3.pdf",
+                                   "content_type": "application/pdf", "size": 10485760}),
+}
+
+RECIPIENTS = 5
+NUMBER = 20000
+
+
+def bench(label: str, message: WebSocketMessage):
+    payload = message.model_dump()
+    print(f"\n{label}")
+    print(f"  {'format':<10}{'bytes':>8}{'encode us':>12}")
+    # 当前实现：pydantic 直接输出 JSON
+    seconds = timeit.timeit(message.model_dump_json, number=NUMBER)
+    print(f"  {'pydantic':<10}{len(message.model_dump_json().encode()):>8}{seconds / NUMBER * 1e6:>12.2f}")
+    for fmt in ws_codec.available_formats():
+        encoded = ws_codec.encode(payload, fmt)
+        size = len(encoded.encode() if isinstance(encoded, str) else encoded)
+        seconds = timeit.timeit(lambda: ws_codec.encode(payload, fmt), number=NUMBER)
+        print(f"  {fmt:<10}{size:>8}{seconds / NUMBER * 1e6:>12.2f}")
+
+
+def bench_fanout(message: WebSocketMessage):
+    """一条消息发给 RECIPIENTS 个设备，设备使用的编码各不相同"""
+    payload = message.model_dump()
+    formats = [ws_codec.available_formats()[i % len(ws_codec.available_formats())] for i in range(RECIPIENTS)]
+
+    def per_connection():
+        for fmt in formats:
+            ws_codec.encode(payload, fmt)
+
+    def shared():
+        shared_message = EncodedMessage(payload)
+        for fmt in formats:
+            shared_message.encode(fmt)
+
+    per_connection_seconds = timeit.timeit(per_connection, number=NUMBER)
+    shared_seconds = timeit.timeit(shared, number=NUMBER)
+    print(f"\nfanout to {RECIPIENTS} devices ({', '.join(formats)})")
+    print(f"  encode per connection: {per_connection_seconds / NUMBER * 1e6:.2f} us")
+    print(f"  encode once per format: {shared_seconds / NUMBER * 1e6:.2f} us")
+
+
+if __name__ == "__main__":
+    print(f"formats: {', '.join(ws_codec.available_formats())}")
+    for name, msg in MESSAGES.items():
+        bench(name, msg)
+    bench_fanout(MESSAGES["image"])
@@ -1,4 +1,5 @@
 import asyncio
+import hashlib
 import websockets
 import json
 import requests
@@ -8,6 +9,21 @@ SECRET_KEY: str = "clipboard_key"
 ALGORITHM: str = "HS256"
 
 
+def apply_delta(base, delta):
+    """整数 n > 0 复制基准文本 n 个字符，n < 0 跳过 -n 个字符，字符串为插入的文本"""
+    parts = []
+    position = 0
+    for op in delta:
+        if isinstance(op, str):
+            parts.append(op)
+        elif op > 0:
+            parts.append(base[position:position + op])
+            position += op
+        else:
+            position -= op
+    return "".join(parts)
+
+
 class ClipboardClient:
     def __init__(self, base_url):
         self.base_url = base_url
@@ -16,6 +32,9 @@ class ClipboardClient:
         self.device_id = None
         self.current_version = 0
         self.ws_connected = False
+        self.websocket = None
+        self.heartbeat_interval = 30  # 期望的心跳间隔（秒）
+        self.texts = {}  # 最近收到的文本，按哈希查找增量推送的基准
 
     def register(self, email, password):
         response = requests.post(f"{self.base_url}/auth/register", json={
@@ -55,13 +74,15 @@ class ClipboardClient:
         ws_url = f"ws{self.base_url[4:]}/sync/notify?token={self.access_token}"
 
         async with websockets.connect(ws_url) as websocket:
+            self.websocket = websocket
             self.ws_connected = True
             print("WebSocket connected")
 
             # 发送初始化消息（当前版本）
             init_msg = json.dumps({
                 "action": "init",
-                "version": self.current_version
+                "version": self.current_version,
+                "heartbeat": self.heartbeat_interval
             })
             await websocket.send(init_msg)
 
@@ -80,7 +101,18 @@ class ClipboardClient:
                 type = web_message.get("type")
                 data = web_message.get("data")
                 data_hash = web_message.get("data_hash")
+                if web_message.get("delta") and web_message.get("base_hash") in self.texts:
+                    # 增量推送，在本地已有的基准文本上应用差异
+                    data = apply_delta(self.texts[web_message["base_hash"]], web_message["delta"])
+                    if hashlib.md5(data.encode()).hexdigest() != data_hash:
+                        data = self.fetch_content(web_message["content_url"], data_hash)
+                elif web_message.get("content_url"):
+                    # 大文本只推送了预览，需要时再获取全文
+                    data = self.fetch_content(web_message["content_url"], data_hash)
+                if type == "text":
+                    self.texts[data_hash] = data
                 print(f"received websocket data. type: {type} data: {data} hash: {data_hash}")
+                self.current_version = max(self.current_version, web_message.get("id") or 0)
                 # latest_version = data["latest_version"]
                 # new_items_count = data["new_items_count"]
                 #
@@ -89,9 +121,19 @@ class ClipboardClient:
                 # 触发同步操作
                 # await self.sync_clipboard()
 
+            elif action == "replay":
+                # 连接后补发的离线期间条目
+                for item in web_message["items"]:
+                    self.update_local_clipboard(item)
+                self.current_version = max(self.current_version, web_message["last_version"])
+                if web_message["done"] and web_message["has_more"]:
+                    # 补发条数达到上限，剩余条目通过同步接口获取
+                    await self.sync_clipboard()
+
             elif action == "heartbeat":
-                # 心跳检测
+                # 心跳检测，回复后服务器才认为连接存活
                 print("Heartbeat received")
+                await self.websocket.send(json.dumps({"action": "heartbeat"}))
 
         except Exception as e:
             print(f"Error handling message: {e}")
@@ -119,10 +161,23 @@ class ClipboardClient:
         except Exception as e:
             print(f"Sync error: {e}")
 
+    def fetch_content(self, content_url, data_hash):
+        """获取只推送了预览的大文本全文，并用哈希校验"""
+        response = requests.get(
+            f"{self.base_url}{content_url}",
+            headers={"Authorization": f"Bearer {self.access_token}"}
+        )
+        response.raise_for_status()
+        if hashlib.md5(response.content).hexdigest() != data_hash:
+            raise Exception(f"Content hash mismatch: {content_url}")
+        return response.text
+
     def update_local_clipboard(self, item):
         """更新本地剪贴板内容"""
         # 注意：避免循环触发
         if item["source_device"] != self.device_id:
+            if item.get("content_url"):
+                item["data"] = self.fetch_content(item["content_url"], item["data_hash"])
             print(f"Updating clipboard with: {item['data'][:50]}...")
 
             # 实际应用中调用系统剪贴板API
@@ -0,0 +1,137 @@
+"""
+多 worker 通知投递测试
+
+启动一个 backplane broker 和两个独立的服务进程（共享同一个 SQLite 数据库），
+设备 A 连接 worker 1 上传内容，验证连接在 worker 2 上的设备 B 能收到通知
+
+用法（在项目根目录执行）：python test/multi_worker.py
+"""
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"port {port} not ready")
+
+
+class Cluster:
+    def __init__(self, workers: int = 2):
+        self.workdir = tempfile.mkdtemp(prefix="clipboard-multi-worker-")
+        # 服务以相对路径读取 static 目录
+        os.symlink(os.path.join(ROOT, "static"), os.path.join(self.workdir, "static"))
+        self.broker_port = free_port()
+        self.ports = [free_port() for _ in range(workers)]
+        self.processes = []
+        self.env = {
+            **os.environ,
+            "PYTHONPATH": ROOT,
+            "DATABASE_URL": f"sqlite:///{os.path.join(self.workdir, 'clipboard.db')}",
+            "BACKPLANE_URL": f"tcp://127.0.0.1:{self.broker_port}",
+            "LOG_ENABLE_FILE": "False",
+            "LOG_LEVEL": "WARNING",
+            "DB_AUTO_UPGRADE": "False",
+        }
+
+    def start(self):
+        self._spawn([sys.executable, os.path.join(ROOT, "backplane.py"), "--port", str(self.broker_port)])
+        wait_for_port(self.broker_port)
+        # 启动前升级一次数据库结构，worker 不再各自建表
+        subprocess.run([sys.executable, os.path.join(ROOT, "migrate.py")], cwd=self.workdir, env=self.env, check=True)
+        for port in self.ports:
+            self._spawn([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"])
+            wait_for_port(port)
+
+    def _spawn(self, args):
+        self.processes.append(subprocess.Popen(args, cwd=self.workdir, env=self.env))
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait(timeout=10)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def url(self, worker: int) -> str:
+        return f"http://127.0.0.1:{self.ports[worker]}"
+
+
+def login(base_url: str, email: str, device_id: str) -> str:
+    requests.post(f"{base_url}/auth/register", json={"email": email, "password": "password"})
+    response = requests.post(f"{base_url}/auth/login", json={
+        "email": email,
+        "password": "password",
+        "device_id": device_id,
+        "device_name": device_id,
+        "device_type": "linux",
+    })
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+def upload_text(base_url: str, token: str, text: str) -> dict:
+    response = requests.post(f"{base_url}/clipboard", data={"type": "text", "data": text},
+                             headers={"Authorization": f"Bearer {token}"})
+    response.raise_for_status()
+    return response.json()
+
+
+async def receive_update(websocket, timeout: float = 5) -> dict:
+    while True:
+        message = json.loads(await asyncio.wait_for(websocket.recv(), timeout))
+        if message.get("action") == "update":
+            return message
+
+
+async def run(cluster: Cluster):
+    worker_1, worker_2 = cluster.url(0), cluster.url(1)
+    token_a = login(worker_1, "multi@example.com", "device-a")
+    token_b = login(worker_2, "multi@example.com", "device-b")
+
+    async with websockets.connect(f"ws{worker_2[4:]}/sync/notify?token={token_b}") as websocket:
+        # A 通过 worker 1 上传，B 在 worker 2 上收到
+        first = upload_text(worker_1, token_a, "hello from worker 1")
+        message = await receive_update(websocket)
+        assert message["data"] == "hello from worker 1", message
+        print("cross-worker delivery: ok")
+
+        # B 通过 worker 2 上传新内容后，worker 1 不能把旧内容当作重复上传
+        upload_text(worker_2, token_b, "hello from worker 2")
+        again = upload_text(worker_1, token_a, "hello from worker 1")
+        assert again["id"] != first["id"], (first, again)
+        message = await receive_update(websocket)
+        assert message["data"] == "hello from worker 1", message
+        print("cross-worker latest item: ok")
+
+
+if __name__ == "__main__":
+    cluster = Cluster()
+    try:
+        cluster.start()
+        asyncio.run(run(cluster))
+    finally:
+        cluster.stop()
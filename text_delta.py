@@ -0,0 +1,125 @@
+"""
+文本条目的增量推送
+很多更新只是在上一条文本上小改（修改命令行参数、编辑段落），开启 NOTIFY_DELTA_ENABLED 后
+推送消息额外带上相对用户上一条文本条目的差异：
+    delta:     操作列表，整数 n > 0 表示复制基准文本接下来的 n 个字符，n < 0 表示跳过 -n 个字符，
+               字符串表示插入该文本
+    base_hash: 基准文本的哈希
+此时 data 只是预览（同大文本推送），本地有 base_hash 对应文本的设备应用差异得到全文并用 data_hash 校验，
+没有时通过 content_url 获取全文。条目仍然完整存储
+"""
+import difflib
+import json
+from typing import Optional, Union
+
+from starlette.concurrency import run_in_threadpool
+
+import crud_async
+import models
+from config import settings
+from database import get_async_db_context
+from sync_payload import content_url
+
+Delta = list[Union[int, str]]
+
+# 差异超过全文该比例时不值得增量推送
+MAX_DELTA_RATIO = 0.5
+# 去掉公共前后缀后中间部分不超过该字符数时逐字符比较，否则整体替换
+# （SequenceMatcher 最坏为平方复杂度，4096 字符的相似文本需要数秒，1024 字符约 60ms）
+MAX_DIFF_CHARS = 1024
+
+
+def make_delta(base: str, text: str, max_insert: Optional[int] = None) -> Optional[Delta]:
+    """
+    计算从 base 得到 text 的差异
+
+    Args:
+        max_insert: 插入的字符数必然超过该值时不再逐字符比较，返回 None
+    """
+    # 大多数编辑集中在一处，先去掉公共前缀和后缀
+    limit = min(len(base), len(text))
+    prefix = 0
+    while prefix < limit and base[prefix] == text[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and base[-suffix - 1] == text[-suffix - 1]:
+        suffix += 1
+
+    delta: Delta = []
+    if prefix:
+        delta.append(prefix)
+    base_middle = base[prefix:len(base) - suffix]
+    text_middle = text[prefix:len(text) - suffix]
+    if len(base_middle) <= MAX_DIFF_CHARS and len(text_middle) <= MAX_DIFF_CHARS:
+        matcher = difflib.SequenceMatcher(None, base_middle, text_middle, autojunk=False)
+        if max_insert is not None:
+            # quick_ratio 只统计字符频次，给出匹配字符数的上界，能在线性时间内排除差异过大的文本
+            max_matches = matcher.quick_ratio() * (len(base_middle) + len(text_middle)) / 2
+            if len(text_middle) - max_matches > max_insert:
+                return None
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                delta.append(i2 - i1)
+                continue
+            if i2 > i1:
+                delta.append(i1 - i2)
+            if j2 > j1:
+                delta.append(text_middle[j1:j2])
+    else:
+        if max_insert is not None and len(text_middle) > max_insert:
+            return None
+        if base_middle:
+            delta.append(-len(base_middle))
+        if text_middle:
+            delta.append(text_middle)
+    if suffix:
+        delta.append(suffix)
+    return delta
+
+
+def apply_delta(base: str, delta: Delta) -> str:
+    """在 base 上应用差异"""
+    parts = []
+    position = 0
+    for op in delta:
+        if isinstance(op, str):
+            parts.append(op)
+        elif op > 0:
+            parts.append(base[position:position + op])
+            position += op
+        else:
+            position -= op
+    return "".join(parts)
+
+
+async def delta_fields(item: models.ClipboardItem) -> dict:
+    """
+    推送消息中的增量字段，不适合增量推送时返回空字典
+
+    只对不小于 NOTIFY_DELTA_MIN_BYTES 的文本计算差异，差异小于全文的 MAX_DELTA_RATIO 时才使用
+    """
+    if item.item_type != "text":
+        return {}
+    text = item.plain_content
+    if not text or len(text.encode("utf-8")) < settings.NOTIFY_DELTA_MIN_BYTES:
+        return {}
+
+    async with get_async_db_context() as db:
+        base_item = await crud_async.get_previous_text_item(db, item.user_id, item.id)
+    if not base_item or not base_item.content_hash or base_item.content_hash == item.content_hash:
+        return {}
+    base = base_item.plain_content or ""
+
+    size = len(text.encode("utf-8"))
+    max_delta_bytes = int(size * MAX_DELTA_RATIO)
+    # 逐字符比较是 CPU 密集的，放在线程池中执行，不阻塞事件循环
+    delta = await run_in_threadpool(make_delta, base, text, max_delta_bytes)
+    if delta is None or len(json.dumps(delta, ensure_ascii=False).encode("utf-8")) > max_delta_bytes:
+        return {}
+    return {
+        "data": text[:settings.NOTIFY_PREVIEW_CHARS],
+        "size": size,
+        "content_url": content_url(item.id),
+        "delta": delta,
+        "base_hash": base_item.content_hash,
+    }
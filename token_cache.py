@@ -0,0 +1,132 @@
+"""
+已验证 JWT 的内存缓存
+设备长期使用同一个访问令牌，每个请求和 WebSocket 连接都要重新校验签名并解析。
+验证通过的令牌按摘要缓存其内容，到令牌的 exp 为止；令牌被吊销（按 jti 或按登录 family）时立即从缓存中移除。
+吊销记录保存在内存中，检查不需要查询数据库，数据库中的吊销记录由 token_revocation 增量同步过来
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from jose import ExpiredSignatureError, JWTError, jwt
+
+from config import settings
+
+
+class TokenRevoked(JWTError):
+    """令牌已被吊销"""
+
+
+def _digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+class VerifiedTokenCache:
+    """按令牌摘要缓存已验证的 claims，超过容量时淘汰最久未使用的令牌"""
+
+    def __init__(self, max_entries: int):
+        self._max_entries = max_entries
+        # 令牌摘要 -> claims
+        self._entries: OrderedDict[bytes, dict] = OrderedDict()
+        # jti -> 令牌摘要，吊销时找到缓存的令牌
+        self._by_jti: dict[str, bytes] = {}
+        # family_id -> 该 family 中已缓存令牌的摘要
+        self._by_family: dict[str, set[bytes]] = {}
+        # 已吊销的 jti / family_id -> 令牌过期时间，过期后不再需要记录
+        self._revoked: dict[str, float] = {}
+        self._revoked_families: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "revoked": 0}
+
+    def decode(self, token: str) -> dict:
+        """
+        校验并解析令牌，与 jwt.decode 一样在令牌无效时抛出 JWTError，过期时抛出 ExpiredSignatureError，
+        已吊销时抛出 TokenRevoked
+        """
+        key = _digest(token)
+        now = time.time()
+        with self._lock:
+            claims = self._entries.get(key)
+            if claims is not None:
+                if claims.get("exp", now + 1) <= now:
+                    self._remove(key)
+                    raise ExpiredSignatureError("Signature has expired.")
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return claims
+            self.stats["misses"] += 1
+
+        # 签名校验不需要持有锁
+        claims = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        jti = claims.get("jti")
+        family_id = claims.get("fid")
+        with self._lock:
+            if (jti and jti in self._revoked) or (family_id and family_id in self._revoked_families):
+                raise TokenRevoked("Token has been revoked.")
+            if self._max_entries > 0:
+                self._entries[key] = claims
+                if jti:
+                    self._by_jti[jti] = key
+                if family_id:
+                    self._by_family.setdefault(family_id, set()).add(key)
+                while len(self._entries) > self._max_entries:
+                    self._remove(next(iter(self._entries)))
+        return claims
+
+    def _remove(self, key: bytes):
+        claims = self._entries.pop(key, None)
+        if not claims:
+            return
+        if claims.get("jti"):
+            self._by_jti.pop(claims["jti"], None)
+        family_id = claims.get("fid")
+        if family_id and family_id in self._by_family:
+            self._by_family[family_id].discard(key)
+            if not self._by_family[family_id]:
+                del self._by_family[family_id]
+
+    def revoke(self, jti: str, expires_at: float):
+        """吊销令牌，expires_at 为令牌的 exp，之后令牌本身已失效"""
+        now = time.time()
+        with self._lock:
+            if expires_at > now:
+                self._revoked[jti] = expires_at
+            key = self._by_jti.get(jti)
+            if key:
+                self._remove(key)
+            self.stats["revoked"] += 1
+            # 清理已经过期的吊销记录
+            if len(self._revoked) > 2 * max(self._max_entries, 1):
+                self._revoked = {j: exp for j, exp in self._revoked.items() if exp > now}
+
+    def revoke_family(self, family_id: str, expires_at: float):
+        """吊销一次登录轮换出的所有令牌，expires_at 之后该 family 的令牌都已过期"""
+        now = time.time()
+        with self._lock:
+            if expires_at <= now:
+                return
+            if family_id not in self._revoked_families:
+                self.stats["revoked"] += 1
+            self._revoked_families[family_id] = expires_at
+            for key in list(self._by_family.get(family_id, ())):
+                self._remove(key)
+
+    def purge_expired_revocations(self):
+        now = time.time()
+        with self._lock:
+            self._revoked = {j: exp for j, exp in self._revoked.items() if exp > now}
+            self._revoked_families = {f: exp for f, exp in self._revoked_families.items() if exp > now}
+
+    def get_stats(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0,
+            "size": len(self._entries),
+            "revocation_list": len(self._revoked) + len(self._revoked_families),
+        }
+
+
+# 全局已验证令牌缓存实例
+verified_tokens = VerifiedTokenCache(settings.JWT_CACHE_MAX_ENTRIES)
@@ -0,0 +1,97 @@
+"""
+令牌吊销记录的同步
+吊销（刷新令牌重用、退出登录、删除设备）写入 token_revocations 表，并通过消息总线立即通知各 worker；
+每个 worker 再按 id 定期增量读取该表，补上错过的消息（如 worker 刚启动或消息总线断开），
+认证时只检查内存中的吊销记录，不查询数据库
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import crud_async
+import log
+from config import settings
+from database import get_async_db_context
+from token_cache import verified_tokens
+
+# 并发事务提交顺序可能与 id 顺序不同，每次同步重新读取游标之前的若干条记录
+SYNC_OVERLAP = 100
+# 清理过期刷新令牌和吊销记录的间隔（秒）
+PURGE_INTERVAL_SECONDS = 3600
+
+
+def family_revocation_expiry() -> datetime:
+    """吊销记录的过期时间：family 此后不会再签发令牌，已签发的令牌都会在此之前过期"""
+    days = max(settings.ACCESS_TOKEN_EXPIRE_DAYS, settings.REFRESH_TOKEN_EXPIRE_DAYS)
+    return datetime.now(timezone.utc) + timedelta(days=days)
+
+
+def _timestamp(value: datetime) -> float:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+class TokenRevocationSync:
+    """stats 记录同步到内存的吊销记录数和失败次数"""
+
+    def __init__(self):
+        self._cursor = 0
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "synced": 0,
+            "sync_failures": 0,
+            "purged": 0,
+        }
+
+    async def sync(self):
+        """读取游标之后新增的吊销记录"""
+        now = datetime.now(timezone.utc)
+        after_id = max(self._cursor - SYNC_OVERLAP, 0)
+        while True:
+            async with get_async_db_context() as db:
+                revocations = await crud_async.get_token_revocations_since(db, after_id, now)
+            for revocation in revocations:
+                verified_tokens.revoke_family(revocation.family_id, _timestamp(revocation.expires_at))
+                if revocation.id > self._cursor:
+                    self.stats["synced"] += 1
+            if not revocations:
+                break
+            after_id = revocations[-1].id
+            self._cursor = max(self._cursor, after_id)
+
+    async def purge(self):
+        now = datetime.now(timezone.utc)
+        async with get_async_db_context() as db:
+            purged = await crud_async.delete_expired_tokens(db, now)
+            await db.commit()
+        verified_tokens.purge_expired_revocations()
+        self.stats["purged"] += purged
+
+    async def _loop(self):
+        last_purge = 0.0
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(settings.TOKEN_REVOCATION_SYNC_SECONDS)
+            try:
+                await self.sync()
+                if loop.time() - last_purge >= PURGE_INTERVAL_SECONDS:
+                    await self.purge()
+                    last_purge = loop.time()
+            except Exception as e:
+                self.stats["sync_failures"] += 1
+                log.error(f'Sync token revocations failed: {e}')
+
+    async def start(self):
+        """启动前先加载所有未过期的吊销记录"""
+        await self.sync()
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+# 全局令牌吊销同步实例
+token_revocations = TokenRevocationSync()
@@ -0,0 +1,64 @@
+"""
+上传请求体大小限制
+Starlette 在调用接口前就会把整个 multipart 请求体解析到临时文件，接口中再检查文件大小时请求已经全部收完。
+该中间件在读取请求体之前按 Content-Length 直接返回 413；没有 Content-Length（分块传输）时
+边接收边计数，超过上限立即中止
+"""
+from fastapi import HTTPException, status
+from starlette.responses import JSONResponse
+
+from file_storage import max_upload_size
+
+# multipart 边界、表单字段等额外开销的余量
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class UploadLimitMiddleware:
+    """只限制 paths 中的 POST multipart 请求"""
+
+    def __init__(self, app, paths: tuple[str, ...]):
+        self.app = app
+        self.paths = paths
+
+    @staticmethod
+    def _limit() -> int:
+        return max_upload_size() + MULTIPART_OVERHEAD
+
+    @staticmethod
+    def _message() -> str:
+        return f"File size exceeds {max_upload_size() // (1024 * 1024)}MB limit"
+
+    def _reject(self) -> JSONResponse:
+        # 与 HTTPException 的错误响应格式一致
+        return JSONResponse(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            content={"error": {"code": "UNKNOWN_ERROR", "message": self._message()}}
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        if not headers.get(b"content-type", b"").startswith(b"multipart/form-data"):
+            return await self.app(scope, receive, send)
+
+        limit = self._limit()
+        content_length = headers.get(b"content-length")
+        if content_length is not None:
+            if content_length.isdigit() and int(content_length) > limit:
+                return await self._reject()(scope, receive, send)
+            return await self.app(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            # 解析请求体时抛出的 HTTPException 会原样交给异常处理器
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=self._message())
+            return message
+
+        await self.app(scope, limited_receive, send)
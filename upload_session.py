@@ -0,0 +1,195 @@
+"""
+可续传的分块上传会话
+客户端先创建会话，再按序号和偏移量逐块 PUT，断线后查询进度从断点继续，
+所有分块接收完成后合并进内容寻址存储。分块追加到临时文件并增量计算哈希，
+过期会话由后台任务定期清理
+"""
+import asyncio
+import hashlib
+import os
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+
+import blob_store
+import log
+from config import settings
+from file_storage import UPLOAD_DIR, SavedFile
+
+TMP_DIR = os.path.join(UPLOAD_DIR, "tmp")
+
+
+class UploadSessionError(Exception):
+    """分块与会话状态不一致，message 会返回给客户端"""
+
+
+@dataclass
+class UploadSession:
+    id: str
+    user_id: str
+    device_id: str
+    item_type: str
+    filename: str
+    content_type: str
+    total_size: int
+    chunk_size: int
+    temp_path: str
+    expires_at: datetime
+    received: int = 0  # 已确认写入的字节数，也是下一个分块的偏移量
+    next_index: int = 0  # 下一个分块序号
+    hasher: "hashlib._Hash" = field(default_factory=hashlib.sha256)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    @property
+    def complete(self) -> bool:
+        return self.received == self.total_size
+
+
+def _write_chunk(session: UploadSession, data: bytes):
+    """
+    在偏移量 received 处写入分块，写入失败时截断回 received 保证文件与进度一致
+
+    哈希和进度在同一个线程函数中一起更新：协程在线程完成后被取消时，进度不会落后于哈希
+    """
+    with open(session.temp_path, "r+b" if os.path.exists(session.temp_path) else "wb") as f:
+        try:
+            f.seek(session.received)
+            f.write(data)
+            f.truncate()
+        except BaseException:
+            f.truncate(session.received)
+            raise
+    session.hasher.update(data)
+    session.received += len(data)
+    session.next_index += 1
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class UploadSessionManager:
+    """上传会话管理，会话保存在当前进程内存中"""
+
+    def __init__(self):
+        self._sessions: dict[str, UploadSession] = {}
+        self._cleanup_task: Optional[asyncio.Task] = None
+
+    def create(self, user_id: str, device_id: str, item_type: str, filename: str, content_type: str,
+               total_size: int) -> UploadSession:
+        os.makedirs(TMP_DIR, exist_ok=True)
+        upload_id = uuid.uuid4().hex
+        session = UploadSession(
+            id=upload_id,
+            user_id=user_id,
+            device_id=device_id,
+            item_type=item_type,
+            filename=os.path.basename(filename or "unknown"),
+            content_type=content_type,
+            total_size=total_size,
+            chunk_size=settings.RESUMABLE_CHUNK_SIZE_KB * 1024,
+            temp_path=os.path.join(TMP_DIR, f"{upload_id}.part"),
+            expires_at=self._new_expiry(),
+        )
+        self._sessions[upload_id] = session
+        log.info(f'Upload session {upload_id} created. file: {session.filename} size: {total_size}')
+        return session
+
+    def get(self, upload_id: str, user_id: str, device_id: str) -> Optional[UploadSession]:
+        session = self._sessions.get(upload_id)
+        if not session or session.user_id != user_id or session.device_id != device_id:
+            return None
+        if session.expires_at <= datetime.now(timezone.utc):
+            return None
+        return session
+
+    async def append_chunk(self, session: UploadSession, index: int, offset: int, data: bytes):
+        """
+        追加一个分块
+
+        重传已经确认过的分块视为成功（幂等），其他乱序分块抛出 UploadSessionError
+        """
+        async with session.lock:
+            if index < session.next_index and offset < session.received:
+                return
+            if index != session.next_index or offset != session.received:
+                raise UploadSessionError(
+                    f"Expected chunk {session.next_index} at offset {session.received}")
+            if len(data) > session.chunk_size:
+                raise UploadSessionError(f"Chunk exceeds {session.chunk_size} bytes")
+            if session.received + len(data) > session.total_size:
+                raise UploadSessionError("Chunk exceeds declared upload size")
+            if not data and not session.complete:
+                raise UploadSessionError("Empty chunk")
+
+            await run_in_threadpool(_write_chunk, session, data)
+            session.expires_at = self._new_expiry()
+
+    async def finalize(self, session: UploadSession, expected_hash: Optional[str] = None) -> SavedFile:
+        """校验大小和哈希后把临时文件放入内容寻址存储，并结束会话；临时文件作为暂存文件保留到条目提交"""
+        async with session.lock:
+            if not session.complete:
+                raise UploadSessionError(f"Upload incomplete: {session.received}/{session.total_size} bytes")
+            content_hash = session.hasher.hexdigest()
+            if expected_hash and expected_hash.lower() != content_hash:
+                raise UploadSessionError("Content hash mismatch")
+            if session.total_size == 0:
+                # 空文件不会产生任何分块写入
+                open(session.temp_path, "wb").close()
+            saved_file = await run_in_threadpool(blob_store.stage, session.temp_path, session.total_size,
+                                                 content_hash)
+            self._sessions.pop(session.id, None)
+            return saved_file
+
+    async def abort(self, session: UploadSession):
+        async with session.lock:
+            self._sessions.pop(session.id, None)
+            await run_in_threadpool(_remove_file, session.temp_path)
+        log.info(f'Upload session {session.id} aborted')
+
+    async def cleanup_expired(self):
+        """删除过期会话及其临时文件"""
+        now = datetime.now(timezone.utc)
+        expired = [s for s in self._sessions.values() if s.expires_at <= now and not s.lock.locked()]
+        for session in expired:
+            self._sessions.pop(session.id, None)
+            await run_in_threadpool(_remove_file, session.temp_path)
+        if expired:
+            log.info(f'Cleaned up {len(expired)} expired upload sessions')
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(settings.UPLOAD_SESSION_CLEANUP_INTERVAL_SECONDS)
+            try:
+                await self.cleanup_expired()
+            except Exception as e:
+                log.error(f'Upload session cleanup failed: {e}', exc_info=True)
+
+    def start(self):
+        # 上次运行遗留的临时文件：超过会话有效期仍未修改的视为已过期
+        if os.path.isdir(TMP_DIR):
+            deadline = datetime.now().timestamp() - settings.UPLOAD_SESSION_EXPIRE_MINUTES * 60
+            for name in os.listdir(TMP_DIR):
+                path = os.path.join(TMP_DIR, name)
+                if os.path.getmtime(path) < deadline:
+                    _remove_file(path)
+        self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def stop(self):
+        if self._cleanup_task:
+            self._cleanup_task.cancel()
+            self._cleanup_task = None
+
+    @staticmethod
+    def _new_expiry() -> datetime:
+        return datetime.now(timezone.utc) + timedelta(minutes=settings.UPLOAD_SESSION_EXPIRE_MINUTES)
+
+
+# 全局上传会话管理实例
+upload_sessions = UploadSessionManager()
@@ -0,0 +1,106 @@
+"""
+WebSocket 消息编码
+默认使用 JSON 文本帧；客户端可以通过 Sec-WebSocket-Protocol 选择二进制编码：
+    clipboard.msgpack  MessagePack（需要安装 msgpack）
+    clipboard.cbor     CBOR（需要安装 cbor2）
+    clipboard.json     JSON（与不指定子协议相同）
+消息内容与 JSON 完全一致，只是编码不同。广播时同一条消息对每种编码只编码一次，
+所有使用该编码的连接共享编码结果
+"""
+import json
+from typing import Optional, Union
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+FORMAT_JSON = "json"
+FORMAT_MSGPACK = "msgpack"
+FORMAT_CBOR = "cbor"
+
+SUBPROTOCOL_PREFIX = "clipboard."
+
+
+def available_formats() -> list[str]:
+    formats = [FORMAT_JSON]
+    if msgpack:
+        formats.append(FORMAT_MSGPACK)
+    if cbor2:
+        formats.append(FORMAT_CBOR)
+    return formats
+
+
+def negotiate(requested: list[str]) -> tuple[str, Optional[str]]:
+    """
+    按客户端给出的顺序选择第一个支持的子协议
+
+    Returns:
+        (编码格式, 需要在握手中返回的子协议)，客户端没有请求支持的子协议时为 (json, None)
+    """
+    formats = available_formats()
+    for subprotocol in requested:
+        if subprotocol.startswith(SUBPROTOCOL_PREFIX) and subprotocol[len(SUBPROTOCOL_PREFIX):] in formats:
+            return subprotocol[len(SUBPROTOCOL_PREFIX):], subprotocol
+    return FORMAT_JSON, None
+
+
+def encode(payload: dict, fmt: str) -> Union[str, bytes]:
+    if fmt == FORMAT_MSGPACK:
+        return msgpack.packb(payload, use_bin_type=True)
+    if fmt == FORMAT_CBOR:
+        return cbor2.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+
+def decode(data: Union[str, bytes], fmt: str) -> dict:
+    """解码客户端消息，格式不正确时返回空字典"""
+    try:
+        if isinstance(data, str):
+            message = json.loads(data)
+        elif fmt == FORMAT_MSGPACK:
+            message = msgpack.unpackb(data, raw=False)
+        elif fmt == FORMAT_CBOR:
+            message = cbor2.loads(data)
+        else:
+            message = json.loads(data)
+    except Exception:
+        return {}
+    return message if isinstance(message, dict) else {}
+
+
+class EncodedMessage:
+    """
+    待发送的消息，按编码格式缓存编码结果
+
+    可以由 dict 创建，也可以由已经编码好的 JSON 文本创建（如从消息总线收到的消息），
+    JSON 连接直接发送原文本，二进制连接只在第一次需要时解析一次
+    """
+
+    __slots__ = ("_payload", "_encoded")
+
+    def __init__(self, payload: Optional[dict] = None, json_text: Optional[str] = None):
+        self._payload = payload
+        self._encoded: dict[str, Union[str, bytes]] = {}
+        if json_text is not None:
+            self._encoded[FORMAT_JSON] = json_text
+
+    @property
+    def payload(self) -> dict:
+        if self._payload is None:
+            self._payload = json.loads(self._encoded[FORMAT_JSON])
+        return self._payload
+
+    def encode(self, fmt: str) -> Union[str, bytes]:
+        encoded = self._encoded.get(fmt)
+        if encoded is None:
+            encoded = self._encoded[fmt] = encode(self.payload, fmt)
+        return encoded
+
+    def __str__(self) -> str:
+        return self.encode(FORMAT_JSON)